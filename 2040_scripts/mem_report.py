@@ -0,0 +1,83 @@
+# Reports how much memory receiving and decoding one frame allocates on the board, for
+# frames of several sizes. Copy rp2040i2c.py to the board as rp2040i2c.py next to this
+# file saved as code.py and read the results on the serial console.
+#
+# The frames are split into the same 33 byte blocks the host writes before measuring,
+# so the numbers only cover the receiver and the decoder, not the i2c reads.
+import gc
+import json
+import struct
+
+from rp2040i2c import (
+    ENCODING_BINARY,
+    ENCODING_JSON,
+    FRAME_MAGIC,
+    FRAME_REGISTER,
+    MESSAGE_CHUNK_SIZE,
+    OP_PIXEL_RUNS,
+    PROTOCOL_VERSION,
+    FrameReceiver,
+    decode_message,
+)
+
+PIXEL_COUNTS = (10, 60, 120, 480, 960)
+
+receiver = FrameReceiver()
+
+
+def blocks(payload, encoding):
+    frame = struct.pack("<BBBH", FRAME_MAGIC, encoding, 1, len(payload)) + payload
+    return [
+        bytes((FRAME_REGISTER,)) + frame[i : i + MESSAGE_CHUNK_SIZE]
+        for i in range(0, len(frame), MESSAGE_CHUNK_SIZE)
+    ]
+
+
+def json_payload(pixels):
+    colors = {str(i): [i % 256, 0, 0] for i in range(pixels)}
+    return json.dumps({"0": {"set_pixel_colors": colors}}).encode()
+
+
+def runs_payload(pixels):
+    return (
+        bytes((PROTOCOL_VERSION, OP_PIXEL_RUNS, 0, 1))
+        + struct.pack("<HH", 0, pixels)
+        + bytes(pixels * 3)
+    )
+
+
+def measure(chunks, encoding):
+    """Bytes allocated receiving and decoding a frame, with the collector off so it
+    can't free anything in between."""
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.mem_free()
+        receiver.reset()
+        for chunk in chunks:
+            receiver.feed(chunk)
+        received = gc.mem_free()
+        decode_message(encoding, receiver.payload())
+        decoded = gc.mem_free()
+    finally:
+        gc.enable()
+    return before - received, received - decoded
+
+
+print(f"free at start: {gc.mem_free()} bytes, receive buffer: {len(receiver.buffer)}")
+print(f"{'encoding':<10}{'pixels':>8}{'frame':>8}{'receive':>10}{'decode':>10}")
+for name, encoding, make_payload in (
+    ("json", ENCODING_JSON, json_payload),
+    ("runs", ENCODING_BINARY, runs_payload),
+):
+    for pixels in PIXEL_COUNTS:
+        payload = make_payload(pixels)
+        chunks = blocks(payload, encoding)
+        try:
+            received, decoded = measure(chunks, encoding)
+        except (MemoryError, ValueError) as e:
+            print(f"{name:<10}{pixels:>8}{len(payload):>8}  {e}")
+            continue
+        print(f"{name:<10}{pixels:>8}{len(payload):>8}{received:>10}{decoded:>10}")
+        del payload, chunks
+print(f"free at end: {gc.mem_free()} bytes")
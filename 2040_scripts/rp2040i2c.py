@@ -1,10 +1,14 @@
+import gc
+import os
 import time
 import board
 from i2ctarget import I2CTarget
 import json
+import struct
 
 import rainbowio
 import adafruit_ticks
+from adafruit_led_animation import monotonic_ms
 from adafruit_led_animation.color import (
     AMBER,
     AQUA,
@@ -23,7 +27,6 @@ from adafruit_led_animation.color import (
     OLD_LACE,
     TEAL,
 )
-from adafruit_led_animation.group import AnimationGroup
 from adafruit_led_animation.animation.blink import Blink
 from adafruit_led_animation.animation.colorcycle import ColorCycle
 from adafruit_led_animation.animation.comet import Comet
@@ -39,11 +42,88 @@ from adafruit_led_animation.animation.rainbowsparkle import RainbowSparkle
 from adafruit_led_animation.animation.customcolorchase import CustomColorChase
 from adafruit_led_animation.sequence import AnimationSequence
 
-from adafruit_led_animation.helper import PixelMap
 from adafruit_neopxl8 import NeoPxl8
 
 first_led_pin = board.NEOPIXEL0
 
+# Set MULTI_LED_I2C_ADDRESS in settings.toml, e.g. MULTI_LED_I2C_ADDRESS = "0x41", to run
+# several boards on one bus.
+i2c_address = os.getenv("MULTI_LED_I2C_ADDRESS", "0x40")
+if isinstance(i2c_address, str):
+    i2c_address = int(i2c_address, 16)
+
+# Printing to the USB console is slow, so commands and animation changes are only
+# printed with MULTI_LED_VERBOSE = 1 in settings.toml. Errors are always printed.
+VERBOSE = int(os.getenv("MULTI_LED_VERBOSE", 0))
+
+class StrandView:
+    """A strand's contiguous block of pixels in the shared NeoPxl8. Slice assignments and
+    fills are passed on as a single slice assignment on the NeoPxl8, which copies them in
+    C instead of translating every pixel index in Python like PixelMap does."""
+
+    def __init__(self, pixels, start, length) -> None:
+        self.pixels = pixels
+        self.start = start
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def _index(self, index) -> int:
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("pixel index out of range")
+        return self.start + index
+
+    def _slice(self, index):
+        start, stop, step = index.indices(self.length)
+        if step != 1:
+            return [self.start + i for i in range(start, stop, step)]
+        return slice(self.start + start, self.start + max(start, stop))
+
+    def __setitem__(self, index, value) -> None:
+        if not isinstance(index, slice):
+            self.pixels[self._index(index)] = value
+            return
+        indexes = self._slice(index)
+        if isinstance(indexes, slice):
+            self.pixels[indexes] = value
+        else:
+            for i, color in zip(indexes, value):
+                self.pixels[i] = color
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.pixels[self._index(index)]
+        indexes = self._slice(index)
+        if isinstance(indexes, slice):
+            return self.pixels[indexes]
+        return [self.pixels[i] for i in indexes]
+
+    def fill(self, color) -> None:
+        self.pixels[self.start : self.start + self.length] = [color] * self.length
+
+    def show(self) -> None:
+        self.pixels.show()
+
+    @property
+    def brightness(self):
+        return self.pixels.brightness
+
+    @brightness.setter
+    def brightness(self, brightness) -> None:
+        self.pixels.brightness = brightness
+
+    @property
+    def auto_write(self):
+        return self.pixels.auto_write
+
+    @auto_write.setter
+    def auto_write(self, value) -> None:
+        self.pixels.auto_write = value
+
+
 class PixelStrand:
     # Animation settings
     speed: float = 0.1
@@ -56,6 +136,18 @@ class PixelStrand:
     num_sparkles: int = 1
     step: int = 1
     animation_name = "comet"
+    # the settings above, in the order handle_animation_name takes them
+    ANIMATION_ATTRIBUTES = (
+        "speed",
+        "colors",
+        "tail_length",
+        "bounce",
+        "size",
+        "spacing",
+        "period",
+        "num_sparkles",
+        "step",
+    )
 
     def __init__(self, strand) -> None:
         self.strand = strand
@@ -72,56 +164,94 @@ class PixelStrand:
         for name, args in params.items():
             if name == "set_animation":
                 self.strand.fill((0, 0, 0))
-                self.strand.show()
                 anim_name = args
-            elif name == "speed":
-                self.speed = float(args)
-            elif name == "color":
-                if type(args) is str:
-                    color = self.get_color(args)
-                    self.colors = [color]
-                else:
-                    self.colors = [(args[0], args[1], args[2])]
-            elif name == "colors":
-                self.colors = self.parse_colors(args)
-            elif name == "tail_length":
-                self.tail_length = int(args)
-            elif name == "bounce":
-                self.bounce = int(args)
-            elif name == "size":
-                self.size = int(args)
-            elif name == "spacing":
-                self.spacing = int(args)
-            elif name == "period":
-                self.period = int(args)
-            elif name == "num_sparkles":
-                self.num_sparkles = int(args)
-            elif name == "step":
-                self.step = int(args)
             elif name == "set_pixel_colors":
                 should_set_anim = False
                 # clear active animation if we're explicitly setting pixel colors and zero all pixels if switching from animation to manual mode
                 if self.active_animation is not None:
                     self.strand.fill((0, 0, 0))
-                    self.strand.show()
                 self.active_animation = None
                 self.animation_name = ""
                 self.set_pixel_colors(args)
+            elif name == "set_pixel_runs":
+                should_set_anim = False
+                # streamed frames overwrite the whole strand, so there is no need to clear it
+                self.active_animation = None
+                self.animation_name = ""
+                self.set_pixel_runs(args)
             elif name == "sequence":
                 should_set_anim = False
                 self.handle_sequence(args)
-
             else:
-                raise ValueError(f"invalid arg: {name}")
+                attribute, value = self.parse_param(name, args)
+                setattr(self, attribute, value)
         if should_set_anim:
             self.set_animation(anim_name)
-        self.strand.show()
+        # the caller shows the pixels once the whole command has been applied
+
+    def apply_settings(self, animation_name, settings) -> None:
+        """Start an animation from settings parse_param already parsed, like a command
+        setting them would."""
+        self.strand.fill((0, 0, 0))
+        for attribute, value in settings:
+            setattr(self, attribute, value)
+        self.set_animation(animation_name or self.animation_name)
+
+    def build_animation(self, animation_name, settings):
+        """Build the animation apply_settings would start without starting it, so it can
+        be swapped in later with start_built."""
+        attributes = {name: getattr(self, name) for name in self.ANIMATION_ATTRIBUTES}
+        for attribute, value in settings:
+            attributes[attribute] = value
+        animation_name = animation_name or self.animation_name
+        animation = self.handle_animation_name(
+            animation_name,
+            self.strand,
+            *(attributes[name] for name in self.ANIMATION_ATTRIBUTES)
+        )
+        return animation_name, attributes, animation
+
+    def start_built(self, animation_name, attributes, animation) -> None:
+        self.strand.fill((0, 0, 0))
+        for name, value in attributes.items():
+            setattr(self, name, value)
+        self.active_animation = animation
+        self.animation_name = animation_name
+
+    @classmethod
+    def parse_param(cls, name, args):
+        """Parse an animation param into the attribute it sets and its value."""
+        if name == "speed":
+            return "speed", float(args)
+        elif name == "color":
+            if type(args) is str:
+                return "colors", [cls.get_color(args)]
+            return "colors", [(args[0], args[1], args[2])]
+        elif name == "colors":
+            return "colors", cls.parse_colors(args)
+        elif name == "tail_length":
+            return "tail_length", int(args)
+        elif name == "bounce":
+            return "bounce", int(args)
+        elif name == "size":
+            return "size", int(args)
+        elif name == "spacing":
+            return "spacing", int(args)
+        elif name == "period":
+            return "period", int(args)
+        elif name == "num_sparkles":
+            return "num_sparkles", int(args)
+        elif name == "step":
+            return "step", int(args)
+        raise ValueError(f"invalid arg: {name}")
+
     #TODO: refactor this to pass in all attributes as parameters
     # something like self.active_animation = handleAnimationName()
     # call this from handle sequence to make this easier, need to figure out
     # classy parsing.
     def set_animation(self, animation_name: str):
-        print(f"animation name: {animation_name}")
+        if VERBOSE:
+            print(f"animation name: {animation_name}")
         self.active_animation = self.handle_animation_name(
             animation_name,
             self.strand,
@@ -211,7 +341,8 @@ class PixelStrand:
         else:
             raise ValueError("invalid animation name")
 
-    def get_color(self, color: str) -> adafruit_led_animation.color:
+    @classmethod
+    def get_color(cls, color: str) -> adafruit_led_animation.color:
         color_map = {
             "amber": AMBER,
             "aqua": AQUA,
@@ -235,26 +366,40 @@ class PixelStrand:
             raise ValueError(f"invalid color name {color}")
         return strip_color
 
-    def parse_colors(self, color_args):
+    @classmethod
+    def parse_colors(cls, color_args):
         new_colors = []
         for color in color_args:
             if type(color) is str:
-                new_colors.append(self.get_color(color))
+                new_colors.append(cls.get_color(color))
             else:
                 new_colors.append((color[0], color[1], color[2]))
         return new_colors
 
-    def set_pixel_colors(self, pixel_colors: dict):
+    def set_pixel_colors(self, pixel_colors):
+        if not isinstance(pixel_colors, dict):
+            # binary messages carry pixel runs
+            self.set_pixel_runs(pixel_colors)
+            return
         for pixel, color in pixel_colors.items():
             # convert from floats to ints
             self.strand[int(pixel)] = [int(y) for y in color]
-        self.strand.show()
+
+    def set_pixel_runs(self, runs) -> None:
+        # runs of packed rgb bytes are copied straight into the NeoPxl8 buffer, fills
+        # carry a single color
+        for start, count, rgb in runs:
+            if len(rgb) == count * 3:
+                self.strand[start : start + count] = rgb
+            else:
+                self.strand[start : start + count] = [(rgb[0], rgb[1], rgb[2])] * count
 
     def get_active_animation(self) -> Animation:
         return self.active_animation
 
     def handle_sequence(self, sequence: dict):
-        print("handling sequence")
+        if VERBOSE:
+            print("handling sequence")
         animations = []
         for animation in sequence.get("animations", []):
             animation_name = animation["set_animation"]
@@ -289,9 +434,11 @@ class PixelDisplay:
 
     pixels = None
     strand_list = []
-    has_active_animations = False
-
-    animations: AnimationGroup = None
+    # (strand index, animation name, settings, animation) built by arm for fire to start
+    armed = []
+    # the running animation of each strand, None for strands showing manually set pixels.
+    # A command only replaces its own strand's slot, so the other strands keep their timing.
+    slots = []
 
     def __init__(self, num_strands, strand_length, brightness) -> None:
         self.reconfigure(num_strands, strand_length, brightness)
@@ -313,117 +460,782 @@ class PixelDisplay:
             auto_write=False,
             brightness=self.brightness,
         )
-        print("set pixels")
-        self.strand_list =  [PixelStrand(self.strand(i, self.strand_length)) for i in range(self.num_strands)]
-        print("set strand list")
+        self.strand_list = [
+            PixelStrand(self.strand(i, self.strand_length))
+            for i in range(self.num_strands)
+        ]
         print(
             f"reconfigured with {self.num_strands} strands, {self.strand_length} pixels per strand, and brigthness of {self.brightness}"
         )
-        self.regenerate_animation_group()
+        self.slots = [pxs.get_active_animation() for pxs in self.strand_list]
+        self.armed = []
 
-    def animate(self):
-        if self.animations == None:
-            self.regenerate_animation_group()
-        # animation legnth of 0 is ok, means all pixels are manually setting values.
-        if self.has_active_animations:
-            self.animations.animate()
+    def set_brightness(self, brightness) -> None:
+        """Change the brightness in place, the strands keep their animations and pixels."""
+        self.brightness = brightness
+        self.pixels.brightness = brightness
+
+    def draw(self) -> bool:
+        # every strand shares the NeoPxl8 buffer, so draw the strands that are due and
+        # let the caller show them all at once. No slots in use is ok, means all pixels
+        # are manually set.
+        drawn = False
+        for animation in self.slots:
+            if animation is not None and animation.animate(show=False):
+                drawn = True
+        return drawn
 
     def set_animation(self, strand_index: int, params: dict):
         if strand_index >= len(self.strand_list):
             raise ValueError("index out of bound for configured number of leds")
-        self.strand_list[strand_index].handle_command(params)
-        self.regenerate_animation_group()
-
-    def regenerate_animation_group(self):
-        raw_anim = []
-        for pxs in self.strand_list:
-            a = pxs.get_active_animation()
-            # active animation can be none if we manually set pixel colors
-            if a is not None:
-                raw_anim.append(a)
-        if len(raw_anim) > 0:
-            self.animations = AnimationGroup(*raw_anim)
-            self.has_active_animations = True
-        else:
-            self.has_active_animations = False
+        pxs = self.strand_list[strand_index]
+        pxs.handle_command(params)
+        self.slots[strand_index] = pxs.get_active_animation()
+
+    def play_scene(self, scene) -> None:
+        for strand_index, animation_name, settings in scene.strands:
+            if strand_index >= len(self.strand_list):
+                raise ValueError("index out of bound for configured number of leds")
+            pxs = self.strand_list[strand_index]
+            if settings is None:
+                # sequences are kept as commands
+                pxs.handle_command(animation_name)
+            else:
+                pxs.apply_settings(animation_name, settings)
+            self.slots[strand_index] = pxs.get_active_animation()
+
+    def arm(self, scene) -> None:
+        """Build the animations of a scene ahead of fire, replacing any armed before."""
+        armed = []
+        for strand_index, animation_name, settings in scene.strands:
+            if strand_index >= len(self.strand_list):
+                raise ValueError("index out of bound for configured number of leds")
+            if settings is None:
+                raise ValueError("sequences can't be armed")
+            pxs = self.strand_list[strand_index]
+            armed.append((strand_index,) + pxs.build_animation(animation_name, settings))
+        self.armed = armed
+
+    def fire(self) -> None:
+        """Start the armed animations from their first step, all on the same tick."""
+        if not self.armed:
+            raise ValueError("no animations armed")
+        now = monotonic_ms()
+        for strand_index, animation_name, attributes, animation in self.armed:
+            self.strand_list[strand_index].start_built(animation_name, attributes, animation)
+            animation.reset()
+            # animations time their steps from _next_update, line them up and draw the
+            # first step right away
+            animation._next_update = now
+            animation.animate(show=False)
+            self.slots[strand_index] = animation
+        self.armed = []
 
     def strand(self, n, pixels_count):
-        return PixelMap(
-            self.pixels,
-            range(n * pixels_count, (n + 1) * pixels_count),
-            individual_pixels=True,
-        )
+        return StrandView(self.pixels, n * pixels_count, pixels_count)
 
 
+# Scenes are strand commands stored under a short id and started with play_scene. Their
+# params are parsed when they are stored, so playing one only starts the animations.
+# Scenes stored with persist are also written to this file, which needs the CIRCUITPY
+# drive to be writable by code.py (storage.remount("/", readonly=False) in boot.py).
+SCENE_FILE = "/scenes.json"
 
-NUM_FETCHES = 100
 
-pixel_display = None
+class Scene:
+    def __init__(self, command) -> None:
+        # kept to write the scene to SCENE_FILE
+        self.command = command
+        self.strands = []
+        for key, params in command.items():
+            if "sequence" in params:
+                self.strands.append((int(key), params, None))
+                continue
+            if "set_pixel_colors" in params or "set_pixel_runs" in params:
+                raise ValueError("scenes can't set pixel colors")
+            settings = [
+                PixelStrand.parse_param(name, args)
+                for name, args in params.items()
+                if name != "set_animation"
+            ]
+            animation_name = params.get("set_animation")
+            if animation_name is not None and animation_name not in ANIMATION_NAMES:
+                raise ValueError("invalid animation name")
+            self.strands.append((int(key), animation_name, settings))
+
+
+class SceneStore:
+    def __init__(self) -> None:
+        self.scenes = {}
+        self.persisted = set()
+
+    def store(self, scene_id, command, persist=False) -> None:
+        self.scenes[scene_id] = Scene(command)
+        if persist:
+            self.persisted.add(scene_id)
+            self.save()
+        elif scene_id in self.persisted:
+            self.persisted.discard(scene_id)
+            self.save()
+
+    def get(self, scene_id) -> Scene:
+        scene = self.scenes.get(scene_id)
+        if scene is None:
+            raise ValueError(f"no scene {scene_id}")
+        return scene
+
+    def save(self) -> None:
+        with open(SCENE_FILE, "w") as f:
+            json.dump({str(i): self.scenes[i].command for i in self.persisted}, f)
+
+    def load(self) -> None:
+        try:
+            with open(SCENE_FILE) as f:
+                stored = json.load(f)
+        except OSError:
+            return
+        for scene_id, command in stored.items():
+            try:
+                self.scenes[int(scene_id)] = Scene(command)
+                self.persisted.add(int(scene_id))
+            except Exception as e:
+                print(f"skipping stored scene {scene_id}: {e}")
+
+
+
+# Messages arrive as frames: a 5 byte header (magic, flags, sequence number and a little
+# endian payload length) followed by the payload. Writes start with a register byte.
+# Frames written as 32 byte smbus blocks repeat it in front of every block and it is
+# dropped here, frames written in one go with i2c_rdwr only have it at the start.
+# The protocol constants and tables below mirror src/protocol.py on the host.
+FRAME_MAGIC = 0xA5
+FRAME_HEADER_SIZE = 5
+FRAME_REGISTER = 0x00
+FRAME_REGISTER_RAW = 0x01
+MESSAGE_CHUNK_SIZE = 32
+BLOCK_SIZE = MESSAGE_CHUNK_SIZE + 1
+# most bytes taken from the i2c peripheral per read
+RECEIVE_SIZE = 64
+# Frames are received into a single buffer allocated at boot, so receiving doesn't
+# allocate per frame. Set MULTI_LED_RECEIVE_BUFFER in settings.toml to accept frames
+# larger than this many bytes.
+RECEIVE_BUFFER_SIZE = int(os.getenv("MULTI_LED_RECEIVE_BUFFER", 8192))
+
+# Writing this register byte on its own selects the status block for the next read. It
+# holds the sequence number of the last frame handled, an error code, a count of frames
+# handled and how long the last frame took to parse and apply in microseconds.
+STATUS_REGISTER = 0x10
+# Selects the frame timing block: the target frame rate, frames shown and dropped since
+# boot, and the average and worst draw, show and start jitter times in microseconds of
+# the frames since the block was last read.
+TIMING_REGISTER = 0x11
+# Selects the telemetry block: main loop passes per second and the average and worst
+# animation draw times in microseconds since the block was last read, free heap bytes,
+# the last command's parse and apply times in microseconds, commands handled since boot,
+# and payloads rejected as undecodable and frames that failed since boot.
+TELEMETRY_REGISTER = 0x12
+READ_REGISTERS = (STATUS_REGISTER, TIMING_REGISTER, TELEMETRY_REGISTER)
+STATUS_OK = 0
+STATUS_FRAME_ERROR = 1
+STATUS_DECODE_ERROR = 2
+STATUS_APPLY_ERROR = 3
+# give up on a frame that has not completed in this many seconds
+FRAME_TIMEOUT = 0.5
+
+# low bits of the frame flags select how the payload is encoded
+ENCODING_JSON = 0x00
+ENCODING_BINARY = 0x01
+ENCODING_TOKENS = 0x02
+ENCODING_MASK = 0x03
+
+PROTOCOL_VERSION = 1
+OP_RECONFIGURE = 0x01
+OP_SET_ANIMATION = 0x02
+OP_PARAMS = 0x03
+OP_SET_PIXEL_COLORS = 0x04
+OP_PIXEL_RUNS = 0x05
+OP_PIXEL_COLOR_RUNS = 0x06
+OP_STORE_SCENE = 0x07
+OP_PLAY_SCENE = 0x08
+# store_scene flag to also write the scene to SCENE_FILE
+SCENE_PERSIST = 0x01
+OP_ARM = 0x09
+OP_FIRE = 0x0A
+OP_SET_BRIGHTNESS = 0x0B
+# set in the pixel count of a run that is filled with a single color
+RUN_FILL = 0x8000
+
+ANIMATION_NAMES = (
+    "blink",
+    "colorcycle",
+    "comet",
+    "chase",
+    "pulse",
+    "sparkle",
+    "solid",
+    "rainbow",
+    "sparkle_pulse",
+    "rainbow_comet",
+    "rainbow_chase",
+    "rainbow_sparkle",
+    "custom_color_chase",
+)
+
+# parameter id -> (name, kind)
+PARAMS = (
+    ("speed", "f"),
+    ("color", "color"),
+    ("colors", "colors"),
+    ("tail_length", "H"),
+    ("bounce", "B"),
+    ("size", "H"),
+    ("spacing", "H"),
+    ("period", "H"),
+    ("num_sparkles", "H"),
+    ("step", "H"),
+)
+
+# same order as the host's protocol.COLORS
+COLOR_NAMES = (
+    "amber",
+    "aqua",
+    "black",
+    "blue",
+    "green",
+    "orange",
+    "pink",
+    "purple",
+    "red",
+    "white",
+    "yellow",
+    "gold",
+    "jade",
+    "magenta",
+    "old_lace",
+    "teal",
+)
+
+# Tokenized JSON payloads have each of these strings, quotes included, replaced by the
+# byte TOKEN_BASE + its index. Must match protocol.TOKENS on the host.
+TOKEN_BASE = 0x80
+TOKENS = (
+    (
+        "set_animation",
+        "set_pixel_colors",
+        "set_pixel_runs",
+        "sequence",
+        "animations",
+        "duration",
+        "reconfigure",
+        "num_strands",
+        "strand_length",
+        "brightness",
+        "store_scene",
+        "play_scene",
+        "id",
+        "command",
+        "persist",
+        "arm",
+        "fire",
+    )
+    + tuple(name for name, _ in PARAMS)
+    + ANIMATION_NAMES
+    + COLOR_NAMES
+    + ("set_brightness",)
+)
+# (token byte, quoted string) pairs, built once so expanding a payload doesn't allocate them
+TOKEN_EXPANSIONS = tuple(
+    (bytes((TOKEN_BASE + i,)), b'"' + name.encode() + b'"') for i, name in enumerate(TOKENS)
+)
+
+
+def decode_message(flags, payload) -> dict:
+    encoding = flags & ENCODING_MASK
+    if encoding == ENCODING_BINARY:
+        return decode_binary(payload)
+    if encoding == ENCODING_JSON:
+        return json.loads(bytes(payload).decode())
+    if encoding == ENCODING_TOKENS:
+        return json.loads(expand_tokens(bytes(payload)).decode())
+    raise ValueError(f"unknown encoding {encoding}")
 
-error_text = ""
 
-with I2CTarget(board.SCL, board.SDA, (0x40,)) as device:
-    while True:
-        # check if there's a pending device request
-        i2c_target_request = device.request()
+def expand_tokens(data: bytes) -> bytes:
+    """Put the strings back in place of the tokens of a tokenized JSON payload."""
+    for token, expansion in TOKEN_EXPANSIONS:
+        if token in data:
+            data = data.replace(token, expansion)
+    return data
 
-        if i2c_target_request:
-            # no request is pending
-            with i2c_target_request:
-                address = i2c_target_request.address
 
-                if i2c_target_request.is_read:
-                    print(f"read request to address '0x{address:02x}'")
+def decode_binary(payload) -> dict:
+    """Decode a binary payload into the same command dict the JSON encoding produces."""
+    data = memoryview(payload)
+    if data[0] != PROTOCOL_VERSION:
+        raise ValueError(f"unsupported protocol version {data[0]}")
+    return decode_records(data, 1, len(data))
 
-                    # if error_text != "":
-                    #     buffer = bytes(error_text.encode("utf-8"))
-                    #     i2c_target_request.write(buffer)
-                    # else:
-                    #     temp = "success"
-                    #     i2c_target_request.write(temp.encode("utf-8"))
+
+def decode_records(data, pos, end) -> dict:
+    command = {}
+    while pos < end:
+        op = data[pos]
+        if op == OP_RECONFIGURE:
+            num_strands, strand_length, brightness = struct.unpack_from("<BHf", data, pos + 1)
+            command["reconfigure"] = {
+                "num_strands": num_strands,
+                "strand_length": strand_length,
+                "brightness": brightness,
+            }
+            pos += 8
+        elif op == OP_SET_PIXEL_COLORS:
+            strand, count = struct.unpack_from("<BH", data, pos + 1)
+            pos += 4
+            pixel_colors = {}
+            for _ in range(count):
+                pixel = data[pos] | (data[pos + 1] << 8)
+                pixel_colors[pixel] = (data[pos + 2], data[pos + 3], data[pos + 4])
+                pos += 5
+            command[strand] = {"set_pixel_colors": pixel_colors}
+        elif op == OP_PIXEL_RUNS or op == OP_PIXEL_COLOR_RUNS:
+            strand = data[pos + 1]
+            count = data[pos + 2]
+            pos += 3
+            runs = []
+            for _ in range(count):
+                start, length = struct.unpack_from("<HH", data, pos)
+                pos += 4
+                size = 3 if length & RUN_FILL else length * 3
+                # slices of the receive buffer, copied into the pixels before the next frame
+                runs.append((start, length & ~RUN_FILL, data[pos : pos + size]))
+                pos += size
+            if op == OP_PIXEL_RUNS:
+                command[strand] = {"set_pixel_runs": runs}
+            else:
+                command[strand] = {"set_pixel_colors": runs}
+        elif op == OP_SET_ANIMATION or op == OP_PARAMS:
+            strand = data[pos + 1]
+            pos += 2
+            params = {}
+            if op == OP_SET_ANIMATION:
+                params["set_animation"] = ANIMATION_NAMES[data[pos]]
+                pos += 1
+            count = data[pos]
+            pos += 1
+            for _ in range(count):
+                name, kind = PARAMS[data[pos]]
+                pos += 1
+                if kind == "f":
+                    params[name] = struct.unpack_from("<f", data, pos)[0]
+                    pos += 4
+                elif kind == "H":
+                    params[name] = data[pos] | (data[pos + 1] << 8)
+                    pos += 2
+                elif kind == "B":
+                    params[name] = data[pos]
+                    pos += 1
+                elif kind == "color":
+                    params[name] = (data[pos], data[pos + 1], data[pos + 2])
+                    pos += 3
                 else:
-                    # transaction is a write request
-                    full_msg = ""
-                    for i in range(NUM_FETCHES):
-                        time.sleep(0.01)
-                        data = i2c_target_request.read(32)
-                        # print(f"received data: {data}")
-                        if len(data) > 0:
-                            full_msg = full_msg + data.decode()
-                    cleaned_msg = full_msg.replace("\x00", "")
-                    command = {}
-                    try:
-                        command = json.loads(cleaned_msg)
-                    except:
-                        print("invalid json received")
-                        print(cleaned_msg)
-                        continue
-                    print(command)
-                    if "reconfigure" in command:
-                        sub_command = command["reconfigure"]
-                        if pixel_display is not None:
-                            pixel_display.reconfigure(
-                                sub_command["num_strands"],
-                                sub_command["strand_length"],
-                                sub_command["brightness"],
-                            )
-                        else:
-                            pixel_display = PixelDisplay(
-                                sub_command["num_strands"],
-                                sub_command["strand_length"],
-                                sub_command["brightness"],
-                            )
-                    else:
-                        for key in command:
-                            try:
-                                pixel_display.set_animation(int(key), command[key])
-                            except Exception as e:
-                                # device.write(
-                                #     json.dumps(f"error setting animation, {e}").encode(
-                                #         "utf-8"
-                                #     )
-                                # )
-                                print(e)
-                                error_text = str(e)
+                    colors = []
+                    for _ in range(data[pos]):
+                        colors.append((data[pos + 1], data[pos + 2], data[pos + 3]))
+                        pos += 3
+                    pos += 1
+                    params[name] = colors
+            command[strand] = params
+        elif op == OP_STORE_SCENE:
+            scene_id, flags, length = struct.unpack_from("<BBH", data, pos + 1)
+            pos += 5
+            command["store_scene"] = {
+                "id": scene_id,
+                "command": decode_records(data, pos, pos + length),
+                "persist": bool(flags & SCENE_PERSIST),
+            }
+            pos += length
+        elif op == OP_PLAY_SCENE:
+            command["play_scene"] = data[pos + 1]
+            pos += 2
+        elif op == OP_ARM:
+            length = data[pos + 1] | (data[pos + 2] << 8)
+            pos += 3
+            command["arm"] = decode_records(data, pos, pos + length)
+            pos += length
+        elif op == OP_FIRE:
+            command["fire"] = 0
+            pos += 1
+        elif op == OP_SET_BRIGHTNESS:
+            command["set_brightness"] = struct.unpack_from("<f", data, pos + 1)[0]
+            pos += 5
+        else:
+            raise ValueError(f"unknown opcode {op}")
+    return command
+
+
+class FrameReceiver:
+    def __init__(self, size=RECEIVE_BUFFER_SIZE) -> None:
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.reset()
+
+    def reset(self) -> None:
+        self.length = 0
+        self.register = -1
+        self.block_offset = 0
+        self.payload_length = -1
+        self.sequence = 0
+        self.flags = 0
+
+    def feed(self, data) -> None:
+        data = memoryview(data)
+        if self.register < 0 and len(data) > 0:
+            self.register = data[0]
+            if self.register in READ_REGISTERS:
+                return
+            if self.register != FRAME_REGISTER and self.register != FRAME_REGISTER_RAW:
+                raise ValueError(f"write to unknown register {self.register}")
+        if self.register in READ_REGISTERS:
+            return
+        if self.register == FRAME_REGISTER_RAW:
+            self.append(data, 1 if self.block_offset == 0 else 0, len(data))
+            self.block_offset = 1
+        else:
+            self.feed_blocks(data)
+
+        if self.payload_length < 0 and self.length >= FRAME_HEADER_SIZE:
+            magic, flags, sequence, length = struct.unpack_from("<BBBH", self.buffer)
+            if magic != FRAME_MAGIC:
+                raise ValueError("invalid frame header")
+            if FRAME_HEADER_SIZE + length > len(self.buffer):
+                raise ValueError(f"frame of {length} bytes is too large")
+            self.flags = flags
+            self.sequence = sequence
+            self.payload_length = length
+
+    def feed_blocks(self, data) -> None:
+        i = 0
+        while i < len(data):
+            if self.block_offset == 0:
+                # skip the register byte at the start of each block
+                i += 1
+                self.block_offset = 1
+                continue
+            take = min(len(data) - i, BLOCK_SIZE - self.block_offset)
+            self.append(data, i, i + take)
+            i += take
+            self.block_offset = (self.block_offset + take) % BLOCK_SIZE
+
+    def append(self, data, start, end) -> None:
+        end = min(end, start + len(self.buffer) - self.length)
+        self.view[self.length : self.length + end - start] = data[start:end]
+        self.length += end - start
+
+    def complete(self) -> bool:
+        return (
+            self.payload_length >= 0
+            and self.length >= FRAME_HEADER_SIZE + self.payload_length
+        )
+
+    def payload(self):
+        # a view of the receive buffer, only valid until the next frame arrives
+        return self.view[FRAME_HEADER_SIZE : FRAME_HEADER_SIZE + self.payload_length]
+
+
+class DeviceStatus:
+    def __init__(self) -> None:
+        self.sequence = 0
+        self.error = STATUS_OK
+        self.frames = 0
+        self.parse_us = 0
+        self.apply_us = 0
+        # since boot, for the telemetry block
+        self.commands = 0
+        self.rejected = 0
+        self.errors = 0
+
+    def record(self, sequence, error, parse_us=0, apply_us=0) -> None:
+        self.sequence = sequence
+        self.error = error
+        self.frames = (self.frames + 1) % 65536
+        self.parse_us = parse_us
+        self.apply_us = apply_us
+        if error == STATUS_DECODE_ERROR:
+            self.rejected += 1
+        else:
+            if error != STATUS_FRAME_ERROR:
+                self.commands += 1
+            if error != STATUS_OK:
+                self.errors += 1
+
+    def pack(self) -> bytes:
+        return struct.pack(
+            "<BBHII", self.sequence, self.error, self.frames, self.parse_us, self.apply_us
+        )
+
+
+class Telemetry:
+    """How busy the main loop is, kept for the telemetry block."""
+
+    def __init__(self) -> None:
+        self.reset_window()
+
+    def reset_window(self) -> None:
+        self.window_start = time.monotonic_ns()
+        self.loops = 0
+        self.animations = 0
+        self.animate_us = 0
+        self.animate_max_us = 0
+
+    def record_animate(self, animate_us) -> None:
+        self.animations += 1
+        self.animate_us += animate_us
+        if animate_us > self.animate_max_us:
+            self.animate_max_us = animate_us
+
+    def pack(self, status) -> bytes:
+        """Pack the telemetry block and start a new window."""
+        elapsed = time.monotonic_ns() - self.window_start
+        data = struct.pack(
+            "<IIIIIIIHH",
+            self.loops * 1000000000 // elapsed if elapsed > 0 else 0,
+            self.animate_us // max(self.animations, 1),
+            self.animate_max_us,
+            gc.mem_free(),
+            status.parse_us,
+            status.apply_us,
+            status.commands,
+            status.rejected % 65536,
+            status.errors % 65536,
+        )
+        self.reset_window()
+        return data
+
+
+def micros() -> int:
+    return time.monotonic_ns() // 1000
+
+
+# Frames are drawn and shown at this rate, set MULTI_LED_FPS in settings.toml to change it.
+# The rest of each frame period is spent taking i2c requests.
+target_fps = int(os.getenv("MULTI_LED_FPS", 60))
+
+
+class FrameScheduler:
+    def __init__(self, fps) -> None:
+        self.fps = fps
+        self.period_ns = 1000000000 // fps
+        self.next_frame = time.monotonic_ns()
+        self.frames = 0
+        self.dropped = 0
+        self.reset_window()
+
+    def reset_window(self) -> None:
+        self.window_frames = 0
+        self.draw_us = 0
+        self.draw_max_us = 0
+        self.show_us = 0
+        self.jitter_us = 0
+        self.jitter_max_us = 0
+
+    def due(self) -> bool:
+        return time.monotonic_ns() >= self.next_frame
+
+    def align(self) -> None:
+        """Start frame periods from now, so boards fired together draw their frames
+        together."""
+        self.next_frame = time.monotonic_ns() + self.period_ns
+
+    def run_frame(self, display) -> int:
+        """Draw and show a frame, then schedule the next one. Frames whose whole period
+        passed while the loop was busy are skipped and counted as dropped.
+
+        Returns:
+            microseconds the animations took to draw
+        """
+        started = time.monotonic_ns()
+        if self.frames == 0:
+            # nothing to drop before the display was configured
+            self.next_frame = started
+        late = started - self.next_frame
+        missed = late // self.period_ns
+        self.dropped += missed
+        self.next_frame += (missed + 1) * self.period_ns
+
+        drawn = display.draw()
+        drawn_at = time.monotonic_ns()
+        if drawn:
+            display.pixels.show()
+        shown_at = time.monotonic_ns()
+
+        draw_us = (drawn_at - started) // 1000
+        jitter_us = (late - missed * self.period_ns) // 1000
+        self.frames += 1
+        self.window_frames += 1
+        self.draw_us += draw_us
+        self.draw_max_us = max(self.draw_max_us, draw_us)
+        self.show_us += (shown_at - drawn_at) // 1000
+        self.jitter_us += jitter_us
+        self.jitter_max_us = max(self.jitter_max_us, jitter_us)
+        return draw_us
+
+    def pack(self) -> bytes:
+        """Pack the timing block and start a new averaging window."""
+        count = max(self.window_frames, 1)
+        data = struct.pack(
+            "<HIIIIIII",
+            self.fps,
+            self.frames,
+            self.dropped,
+            self.draw_us // count,
+            self.draw_max_us,
+            self.show_us // count,
+            self.jitter_us // count,
+            self.jitter_max_us,
+        )
+        self.reset_window()
+        return data
+
+
+pixel_display = None
+
+
+def apply_command(command: dict) -> bool:
+    """Apply a decoded command, returning False if any part of it failed."""
+    global pixel_display
+    if "reconfigure" in command:
+        sub_command = command["reconfigure"]
         if pixel_display is not None:
-            pixel_display.animate()
+            pixel_display.reconfigure(
+                sub_command["num_strands"],
+                sub_command["strand_length"],
+                sub_command["brightness"],
+            )
+        else:
+            pixel_display = PixelDisplay(
+                sub_command["num_strands"],
+                sub_command["strand_length"],
+                sub_command["brightness"],
+            )
+        return True
+    if "set_brightness" in command:
+        pixel_display.set_brightness(float(command["set_brightness"]))
+        pixel_display.pixels.show()
+        return True
+    if "store_scene" in command:
+        sub_command = command["store_scene"]
+        scenes.store(
+            int(sub_command["id"]),
+            sub_command["command"],
+            sub_command.get("persist", False),
+        )
+        return True
+    if "arm" in command:
+        pixel_display.arm(Scene(command["arm"]))
+        return True
+    if "fire" in command:
+        pixel_display.fire()
+        pixel_display.pixels.show()
+        scheduler.align()
+        return True
+    if "play_scene" in command:
+        pixel_display.play_scene(scenes.get(int(command["play_scene"])))
+        pixel_display.pixels.show()
+        return True
+
+    ok = True
+    for key in command:
+        try:
+            pixel_display.set_animation(int(key), command[key])
+        except Exception as e:
+            print(e)
+            ok = False
+    # one show for every strand the command touched
+    if pixel_display is not None:
+        pixel_display.pixels.show()
+    return ok
+
+
+scenes = SceneStore()
+scenes.load()
+receiver = FrameReceiver()
+status = DeviceStatus()
+scheduler = FrameScheduler(target_fps)
+telemetry = Telemetry()
+read_register = STATUS_REGISTER
+
+
+def handle_request(request) -> None:
+    """Answer a read with the selected block, or receive a frame and apply it."""
+    global read_register
+    if request.is_read:
+        if read_register == STATUS_REGISTER:
+            request.write(status.pack())
+        elif read_register == TIMING_REGISTER:
+            request.write(scheduler.pack())
+        elif read_register == TELEMETRY_REGISTER:
+            request.write(telemetry.pack(status))
+        return
+    # transaction is a write request, read until the frame is complete
+    receiver.reset()
+    deadline = time.monotonic() + FRAME_TIMEOUT
+    try:
+        while not receiver.complete() and time.monotonic() < deadline:
+            receiver.feed(request.read(RECEIVE_SIZE))
+            if receiver.register in READ_REGISTERS:
+                break
+    except ValueError as e:
+        print(e)
+        status.record(receiver.sequence, STATUS_FRAME_ERROR)
+        return
+    if receiver.register in READ_REGISTERS:
+        read_register = receiver.register
+        return
+    if not receiver.complete():
+        print("incomplete frame received")
+        status.record(receiver.sequence, STATUS_FRAME_ERROR)
+        return
+    started = micros()
+    try:
+        command = decode_message(receiver.flags, receiver.payload())
+    except Exception as e:
+        print("invalid message received")
+        print(e)
+        status.record(receiver.sequence, STATUS_DECODE_ERROR)
+        return
+    parsed = micros()
+    if VERBOSE:
+        print(command)
+    try:
+        ok = apply_command(command)
+    except Exception as e:
+        print(e)
+        ok = False
+    status.record(
+        receiver.sequence,
+        STATUS_OK if ok else STATUS_APPLY_ERROR,
+        parsed - started,
+        micros() - parsed,
+    )
+
+
+def poll(device) -> None:
+    """One pass of the main loop: draw a frame if one is due, then handle a pending i2c
+    request. sim/ steps the loop through this on a simulated I2CTarget."""
+    telemetry.loops += 1
+    if pixel_display is not None and scheduler.due():
+        telemetry.record_animate(scheduler.run_frame(pixel_display))
+
+    # check if there's a pending device request
+    i2c_target_request = device.request()
+
+    if i2c_target_request:
+        with i2c_target_request:
+            handle_request(i2c_target_request)
+
+
+# code.py runs as __main__, scripts that import this file only get the classes
+if __name__ == "__main__":
+    with I2CTarget(board.SCL, board.SDA, (i2c_address,)) as device:
+        while True:
+            poll(device)
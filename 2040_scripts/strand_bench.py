@@ -0,0 +1,84 @@
+# Compares the cost of writing a strand through PixelMap and through StrandView.
+# Copy rp2040i2c.py to the board as rp2040i2c.py next to this file saved as code.py,
+# with the strands you want to measure plugged in, and read the results on the serial
+# console.
+import time
+
+import board
+from adafruit_led_animation.helper import PixelMap
+from adafruit_neopxl8 import NeoPxl8
+
+from rp2040i2c import StrandView
+
+NUM_STRANDS = 8
+STRAND_LENGTH = 120
+REPEATS = 20
+
+pixels = NeoPxl8(
+    board.NEOPIXEL0,
+    NUM_STRANDS * STRAND_LENGTH,
+    num_strands=NUM_STRANDS,
+    auto_write=False,
+    brightness=0.1,
+)
+packed = bytes(i % 256 for i in range(STRAND_LENGTH * 3))
+colors = [(i % 256, 0, 255 - i % 256) for i in range(STRAND_LENGTH)]
+
+
+def pixel_map(n):
+    return PixelMap(
+        pixels,
+        range(n * STRAND_LENGTH, (n + 1) * STRAND_LENGTH),
+        individual_pixels=True,
+    )
+
+
+def strand_view(n):
+    return StrandView(pixels, n * STRAND_LENGTH, STRAND_LENGTH)
+
+
+def fill(strand):
+    strand.fill((255, 0, 0))
+
+
+def set_each(strand):
+    for i in range(STRAND_LENGTH):
+        strand[i] = colors[i]
+
+
+def set_slice(strand):
+    strand[0:STRAND_LENGTH] = colors
+
+
+def set_packed(strand):
+    strand[0:STRAND_LENGTH] = packed
+
+
+def measure(make_strand, operation) -> float:
+    """Average microseconds to apply an operation to one strand."""
+    strands = [make_strand(n) for n in range(NUM_STRANDS)]
+    started = time.monotonic_ns()
+    for _ in range(REPEATS):
+        for strand in strands:
+            operation(strand)
+    return (time.monotonic_ns() - started) / 1000 / REPEATS / NUM_STRANDS
+
+
+print(f"{NUM_STRANDS} strands of {STRAND_LENGTH} pixels, us per strand")
+print(f"{'operation':<12}{'PixelMap':>12}{'StrandView':>12}")
+for name, operation in (
+    ("fill", fill),
+    ("set_each", set_each),
+    ("set_slice", set_slice),
+    ("set_packed", set_packed),
+):
+    results = []
+    for make_strand in (pixel_map, strand_view):
+        try:
+            results.append(f"{measure(make_strand, operation):>12.0f}")
+        except Exception as e:
+            # PixelMap can't take packed bytes
+            print(f"{name} failed: {e}")
+            results.append(f"{'-':>12}")
+    print(f"{name:<12}{results[0]}{results[1]}")
+pixels.deinit()
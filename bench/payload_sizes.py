@@ -0,0 +1,73 @@
+"""Compare the payload sizes of the host's encodings on the sample commands.
+
+Encodes every command in commands.json, plus a few larger ones, as the JSON the module
+used to send, as compact JSON, as tokenized JSON and with the binary encoding, which
+falls back to tokenized JSON for commands it can't express, and prints the size of each.
+
+    python bench/payload_sizes.py
+"""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from protocol import ENCODING_BINARY, ENCODING_TOKENS, encode_message
+
+from transport_bench import load_commands
+
+ENCODING_NAMES = {ENCODING_BINARY: "binary", ENCODING_TOKENS: "tokens"}
+
+
+def sizes(command) -> tuple:
+    binary_encoding, binary = encode_message(command, ENCODING_BINARY)
+    _, tokens = encode_message(command, ENCODING_TOKENS)
+    return (
+        len(json.dumps(command)),
+        len(json.dumps(command, separators=(",", ":"))),
+        len(tokens),
+        len(binary),
+        ENCODING_NAMES[binary_encoding],
+    )
+
+
+def main() -> None:
+    samples = load_commands()
+    commands = [(f"commands.json #{i}", c) for i, c in enumerate(samples)]
+    commands.append(
+        (
+            "three animations",
+            {
+                "0": {"set_animation": "rainbow_comet", "tail_length": 10, "bounce": 1},
+                "1": {"set_animation": "sparkle_pulse", "color": "purple", "period": 3},
+                "2": {"set_animation": "custom_color_chase", "colors": ["red", "teal"]},
+            },
+        )
+    )
+    commands.append(
+        (
+            "set_pixel_colors x120",
+            {"0": {"set_pixel_colors": {str(i): [i, 0, 255 - i] for i in range(120)}}},
+        )
+    )
+
+    print(f"{'command':<24}{'json':>8}{'compact':>9}{'tokens':>8}{'binary':>8}")
+    # totals only cover the samples in commands.json
+    totals = [0, 0, 0, 0]
+    for i, (name, command) in enumerate(commands):
+        *counts, binary_encoding = sizes(command)
+        if i < len(samples):
+            totals = [total + count for total, count in zip(totals, counts)]
+        binary = f"{counts[3]}{'*' if binary_encoding != 'binary' else ''}"
+        print(f"{name:<24}{counts[0]:>8}{counts[1]:>9}{counts[2]:>8}{binary:>8}")
+    print(f"{'commands.json':<24}{totals[0]:>8}{totals[1]:>9}{totals[2]:>8}{totals[3]:>8}")
+    print(
+        f"tokens save {1 - totals[2] / totals[0]:.0%} on json, "
+        f"{1 - totals[2] / totals[1]:.0%} on compact json"
+    )
+    print("* sent as tokenized json, the binary encoding can't express it")
+
+
+if __name__ == "__main__":
+    main()
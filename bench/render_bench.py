@@ -0,0 +1,168 @@
+"""Measure how the firmware's drawing scales with the number and length of strands.
+
+Runs PixelDisplay from 2040_scripts/rp2040i2c.py on CPython with the simulated
+CircuitPython modules from sim/ and sweeps num_strands x strand_length x animation. For
+every case it records the time to apply a command starting the animation on every strand,
+the time to draw a frame and the peak memory allocated while drawing one, and writes them
+to a JSON file that can be compared with the results of another commit:
+
+    python bench/render_bench.py --output before.json
+    python bench/render_bench.py --output after.json --compare before.json
+
+Showing a frame is left out, the NeoPxl8 does it in C on the board. CPython is far faster
+than the board, so compare the numbers with each other, not with the frame period. Needs
+the bundle libraries from sim/requirements.txt.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sim import load_firmware
+
+NUM_STRANDS = (1, 2, 4, 8)
+STRAND_LENGTHS = (30, 60, 120, 240)
+FRAMES = 100
+APPLY_REPEATS = 5
+# smallest change in draw time reported by --compare, relative and in microseconds
+COMPARE_THRESHOLD = 0.1
+COMPARE_MIN_US = 5
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(__file__),
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def start_command(num_strands: int, animation: str) -> dict:
+    # no delay between steps, so every frame draws a step of every animation
+    return {str(i): {"set_animation": animation, "speed": 0} for i in range(num_strands)}
+
+
+def run_case(firmware, num_strands: int, strand_length: int, animation: str) -> dict:
+    firmware.pixel_display = firmware.PixelDisplay(num_strands, strand_length, 0.5)
+    display = firmware.pixel_display
+    command = start_command(num_strands, animation)
+
+    apply_us = []
+    for _ in range(APPLY_REPEATS):
+        started = time.perf_counter_ns()
+        if not firmware.apply_command(command):
+            raise RuntimeError(f"{animation} failed to start")
+        apply_us.append((time.perf_counter_ns() - started) / 1000)
+
+    draw_us = []
+    for _ in range(FRAMES):
+        started = time.perf_counter_ns()
+        display.draw()
+        draw_us.append((time.perf_counter_ns() - started) / 1000)
+
+    # traced separately, tracing slows everything down
+    alloc = []
+    tracemalloc.start()
+    try:
+        for _ in range(FRAMES):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            display.draw()
+            _, peak = tracemalloc.get_traced_memory()
+            alloc.append(peak - before)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "num_strands": num_strands,
+        "strand_length": strand_length,
+        "animation": animation,
+        "apply_us": statistics.median(apply_us),
+        "draw_us": statistics.median(draw_us),
+        "draw_max_us": max(draw_us),
+        "draw_alloc_bytes": statistics.median(alloc),
+        "draw_alloc_max_bytes": max(alloc),
+    }
+
+
+def case_key(case: dict) -> tuple:
+    return case["num_strands"], case["strand_length"], case["animation"]
+
+
+def compare(results: dict, baseline_file: str) -> None:
+    """Print the cases whose draw time or allocations changed against a baseline."""
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    before = {case_key(case): case for case in baseline["cases"]}
+    print(f"\ncompared with {baseline['commit']}, changes over {COMPARE_THRESHOLD:.0%}")
+    print(f"{'case':<36}{'draw us':>18}{'alloc bytes':>20}")
+    for case in results["cases"]:
+        old = before.get(case_key(case))
+        if old is None:
+            continue
+        change = case["draw_us"] - old["draw_us"]
+        changed = (
+            abs(change) >= COMPARE_MIN_US
+            and abs(change) >= COMPARE_THRESHOLD * old["draw_us"]
+        )
+        if not changed and case["draw_alloc_bytes"] == old["draw_alloc_bytes"]:
+            continue
+        name = "{}x{} {}".format(*case_key(case))
+        print(
+            f"{name:<36}{old['draw_us']:>8.0f} ->{case['draw_us']:>6.0f}"
+            f"{old['draw_alloc_bytes']:>10.0f} ->{case['draw_alloc_bytes']:>6.0f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="render_bench.json")
+    parser.add_argument("--compare", help="results file of an earlier run")
+    parser.add_argument("--animations", nargs="*", help="only run these animations")
+    args = parser.parse_args()
+
+    firmware = load_firmware()
+    animations = args.animations or firmware.ANIMATION_NAMES
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "frames": FRAMES,
+        "cases": [],
+    }
+    print(
+        f"{'strands':>7}{'length':>7}  {'animation':<20}{'apply us':>10}"
+        f"{'draw us':>10}{'max':>8}{'alloc':>8}"
+    )
+    for num_strands in NUM_STRANDS:
+        for strand_length in STRAND_LENGTHS:
+            for animation in animations:
+                case = run_case(firmware, num_strands, strand_length, animation)
+                results["cases"].append(case)
+                print(
+                    f"{num_strands:>7}{strand_length:>7}  {animation:<20}"
+                    f"{case['apply_us']:>10.0f}{case['draw_us']:>10.0f}"
+                    f"{case['draw_max_us']:>8.0f}{case['draw_alloc_bytes']:>8.0f}"
+                )
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"wrote {len(results['cases'])} cases to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
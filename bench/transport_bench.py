@@ -0,0 +1,126 @@
+"""Compare smbus block writes with single i2c_rdwr writes against a fake SMBus.
+
+Counts the syscalls and the bytes on the wire (address and register bytes included) each
+transfer mode needs per command, and estimates the resulting bus time.
+
+    python bench/transport_bench.py
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from protocol import ENCODING_BINARY, build_frame, encode_message, encode_pixel_runs
+from transport import TRANSFER_BLOCK, TRANSFER_RDWR, write_frame
+
+COMMANDS_FILE = os.path.join(os.path.dirname(__file__), "..", "commands.json")
+BUS_SPEEDS = (100_000, 400_000)
+ITERATIONS = 2000
+
+
+class FakeSMBus:
+    """Records what the linux i2c driver would be asked to do."""
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.syscalls = 0
+        self.messages = 0
+        self.wire_bytes = 0
+        self.transactions = 0
+
+    def write_i2c_block_data(self, address, register, data) -> None:
+        self.syscalls += 1
+        self.transactions += 1
+        self.messages += 1
+        # address byte, register byte, data
+        self.wire_bytes += 2 + len(data)
+
+    def i2c_rdwr(self, *messages) -> None:
+        self.syscalls += 1
+        # messages in one call are joined with repeated starts
+        self.transactions += 1
+        for message in messages:
+            self.messages += 1
+            self.wire_bytes += 1 + message.len
+
+
+def load_commands():
+    """commands.json holds several JSON documents back to back."""
+    with open(COMMANDS_FILE) as f:
+        text = f.read()
+    decoder = json.JSONDecoder()
+    commands = []
+    pos = 0
+    while True:
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos >= len(text):
+            return commands
+        command, pos = decoder.raw_decode(text, pos)
+        commands.append(command)
+
+
+def bus_ms(bus: FakeSMBus, speed: int) -> float:
+    # 9 clocks per byte, plus a start and a stop condition per transaction and a
+    # repeated start per extra message
+    clocks = bus.wire_bytes * 9 + bus.transactions * 2 + (bus.messages - bus.transactions)
+    return clocks / speed * 1000
+
+
+def run(name: str, frame: bytes, modes) -> None:
+    bus = FakeSMBus()
+    for label, mode, size in modes:
+        bus.reset()
+        write_frame(bus, 0x40, frame, mode, size)
+        calls = bus.syscalls
+        wire = bus.wire_bytes
+        times = " ".join(f"{bus_ms(bus, speed):7.2f}" for speed in BUS_SPEEDS)
+        start = time.perf_counter()
+        for _ in range(ITERATIONS):
+            write_frame(bus, 0x40, frame, mode, size)
+        host_us = (time.perf_counter() - start) / ITERATIONS * 1e6
+        print(
+            f"{name:<24} {label:<10} {len(frame):>6} {calls:>8} {wire:>6} {times} {host_us:9.1f}"
+        )
+
+
+def main() -> None:
+    modes = (
+        ("block", TRANSFER_BLOCK, 0),
+        ("rdwr", TRANSFER_RDWR, 0),
+        ("rdwr/128", TRANSFER_RDWR, 128),
+    )
+    commands = [(f"commands.json #{i}", c) for i, c in enumerate(load_commands())]
+    commands.append(
+        (
+            "set_pixel_colors x120",
+            {"0": {"set_pixel_colors": {str(i): [i, 0, 255 - i] for i in range(120)}}},
+        )
+    )
+    commands.append(
+        (
+            "fill x120",
+            {"0": {"set_pixel_colors": {str(i): [255, 0, 0] for i in range(120)}}},
+        )
+    )
+
+    speeds = " ".join(f"{speed // 1000:>4}kHz" for speed in BUS_SPEEDS)
+    print(
+        f"{'command':<24} {'mode':<10} {'frame':>6} {'syscalls':>8} {'wire':>6} {speeds} {'host us':>9}"
+    )
+    for name, command in commands:
+        encoding, payload = encode_message(command, ENCODING_BINARY)
+        run(name, build_frame(payload, 1, encoding), modes)
+
+    gradient = bytes(i % 256 for i in range(360))
+    full_frame = encode_pixel_runs({i: [(0, gradient)] for i in range(3)})
+    run("stream frame 3x120", build_frame(full_frame, 1, ENCODING_BINARY), modes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""Runs the board firmware in process against simulated hardware, so the host module
+can be driven end to end without a Pi, a board or strands. See README.md."""
+
+import os
+import sys
+
+# the host modules import each other by their flat names, like they do in src/main.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from sim.bus import DEFAULT_BUS_SPEED, SimulatedSMBus, Simulation
+from sim.device import SimulatedDevice, load_firmware
+
+__all__ = [
+    "DEFAULT_BUS_SPEED",
+    "SimulatedDevice",
+    "SimulatedSMBus",
+    "Simulation",
+    "load_firmware",
+]
@@ -0,0 +1,115 @@
+"""Drive simulated boards through MultiLed and report the end to end latency of commands:
+from do_command being called to the board applying the frame, and to the next frame it
+shows, and check that set_pixel_colors comes out on the strand.
+
+    python -m sim [--boards 2] [--bus-speed 400000] [--transfer-mode rdwr]
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from google.protobuf.struct_pb2 import Struct
+from viam.proto.app.robot import ComponentConfig
+
+from sim import DEFAULT_BUS_SPEED, Simulation
+
+from main import MultiLed
+
+NUM_STRANDS = 4
+STRAND_LENGTH = 60
+REPEATS = 20
+
+COMMANDS = {
+    "set_animation": {"0": {"set_animation": "comet", "speed": 0.05}},
+    "params": {"1": {"color": [255, 0, 0], "period": 2}},
+    "set_pixel_colors": {
+        "2": {"set_pixel_colors": {str(i): [i, 0, 255 - i] for i in range(STRAND_LENGTH)}}
+    },
+    "two_strands": {"3": {"set_animation": "rainbow"}, "0": {"set_animation": "pulse"}},
+}
+
+
+def component_config(boards: int, transfer_mode: str) -> ComponentConfig:
+    attributes = Struct()
+    attributes.update(
+        {
+            "num_strands": NUM_STRANDS * boards,
+            "strand_length": STRAND_LENGTH,
+            "brightness": 0.5,
+            "transfer_mode": transfer_mode,
+            "targets": [
+                {"address": f"0x{0x40 + i:02x}", "num_strands": NUM_STRANDS}
+                for i in range(boards)
+            ],
+        }
+    )
+    return ComponentConfig(name="sim", attributes=attributes)
+
+
+def shown_after(pixels, since: float, timeout: float = 0.5) -> float:
+    """The time of the first show at or after since."""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        for shown_at, _ in list(pixels.history):
+            if shown_at >= since:
+                return shown_at
+        time.sleep(0.0005)
+    raise RuntimeError("the board didn't show the command")
+
+
+async def measure(led: MultiLed, device, name: str, command: dict) -> None:
+    applied_ms = []
+    shown_ms = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        await led.do_command(command)
+        _, _, ok, applying, applied = device.frames[-1]
+        if not ok:
+            raise RuntimeError(f"{name} failed on the board")
+        applied_ms.append((applied - started) * 1000)
+        shown_ms.append((shown_after(device.pixels, applying) - started) * 1000)
+    print(
+        f"{name:<18}{statistics.mean(applied_ms):>10.2f}{max(applied_ms):>10.2f}"
+        f"{statistics.mean(shown_ms):>10.2f}{max(shown_ms):>10.2f}"
+    )
+
+
+async def run(args) -> None:
+    simulation = Simulation(args.bus_speed)
+    devices = [simulation.add_device(1, 0x40 + i, history_size=8) for i in range(args.boards)]
+    with simulation:
+        led = MultiLed.new(component_config(args.boards, args.transfer_mode), {})
+        await asyncio.sleep(0.1)
+        device = devices[0]
+
+        print(f"{args.boards} boards, {args.bus_speed} Hz, {args.transfer_mode} writes")
+        print(f"{'command':<18}{'applied ms':>10}{'max':>10}{'shown ms':>10}{'max':>10}")
+        for name, command in COMMANDS.items():
+            await measure(led, device, name, command)
+
+        expected = bytes(
+            value for i in range(STRAND_LENGTH) for value in (i, 0, 255 - i)
+        )
+        start = 2 * STRAND_LENGTH * 3
+        shown = device.pixels.shown[start : start + STRAND_LENGTH * 3]
+        print(f"set_pixel_colors shown on strand 2: {shown == expected}")
+        for bus, stats in simulation.stats().items():
+            print(f"bus {bus}: {stats}")
+        await led.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m sim", description=__doc__)
+    parser.add_argument("--boards", type=int, default=2)
+    parser.add_argument("--bus-speed", type=int, default=DEFAULT_BUS_SPEED)
+    parser.add_argument("--transfer-mode", default="rdwr", choices=("block", "rdwr"))
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import ctypes
+import errno
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from sim.circuitpython import Transaction
+from sim.device import SimulatedDevice
+
+# standard mode is 100 kHz, fast mode 400 kHz
+DEFAULT_BUS_SPEED = 400_000
+# the linux i2c drivers give up on a transfer the target stretches for longer than this
+TRANSFER_TIMEOUT = 1.0
+# 8 data bits and an ack per byte, plus a start and a stop condition per transfer
+CLOCKS_PER_BYTE = 9
+CLOCKS_PER_TRANSFER = 2
+I2C_M_RD = 0x0001
+
+
+class BusLine:
+    """The wires of one i2c bus. Transfers hold the line for the time their bytes take at
+    the bus speed and then for as long as the board stretches the clock, so transfers
+    from several handles on one bus take turns."""
+
+    def __init__(self, bus_speed: int) -> None:
+        self.bus_speed = bus_speed
+        self.lock = threading.Lock()
+        self.devices: Dict[int, SimulatedDevice] = {}
+        self.transfers = 0
+        self.bytes = 0
+        self.busy = 0.0
+
+    def transfer(self, transaction: Transaction, wire_bytes: int) -> bytes:
+        """Hand a transaction to the addressed board and wait for it to take the bytes or
+        answer the read.
+
+        Raises:
+            OSError: no board answers at the address, or it stretched the clock for
+                longer than TRANSFER_TIMEOUT
+        """
+        device = self.devices.get(transaction.address)
+        if device is None or not device.running:
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+        started = time.perf_counter()
+        # the last byte is only on the board once the transfer's clocks have gone by
+        clocks = wire_bytes * CLOCKS_PER_BYTE + CLOCKS_PER_TRANSFER
+        if self.bus_speed:
+            time.sleep(clocks / self.bus_speed)
+        device.target.submit(transaction)
+        if not transaction.done.wait(TRANSFER_TIMEOUT):
+            raise OSError(errno.ETIMEDOUT, "Connection timed out")
+        if not device.running:
+            # the board stopped while the transfer waited for it
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+        self.transfers += 1
+        self.bytes += wire_bytes
+        self.busy += time.perf_counter() - started
+        return transaction.reply[: transaction.read_size].ljust(
+            transaction.read_size, b"\xff"
+        )
+
+    def stats(self) -> dict:
+        return {"transfers": self.transfers, "bytes": self.bytes, "busy_s": self.busy}
+
+
+class SimulatedSMBus:
+    """The parts of smbus2.SMBus the host module uses, talking to simulated boards."""
+
+    def __init__(self, line: BusLine) -> None:
+        self.line = line
+
+    def __enter__(self) -> "SimulatedSMBus":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        pass
+
+    def write_i2c_block_data(self, i2c_addr: int, register: int, data) -> None:
+        with self.line.lock:
+            # address, register and data bytes
+            self.line.transfer(
+                Transaction(i2c_addr, bytes((register,)) + bytes(data)), 2 + len(data)
+            )
+
+    def read_i2c_block_data(self, i2c_addr: int, register: int, length: int) -> list:
+        with self.line.lock:
+            # the register byte is written, then read back after a repeated start
+            self.line.transfer(Transaction(i2c_addr, bytes((register,))), 2)
+            reply = self.line.transfer(Transaction(i2c_addr, read_size=length), 1 + length)
+        return list(reply)
+
+    def i2c_rdwr(self, *i2c_msgs) -> None:
+        # messages are joined by repeated starts, nothing else gets on the bus in between
+        with self.line.lock:
+            for message in i2c_msgs:
+                if message.flags & I2C_M_RD:
+                    reply = self.line.transfer(
+                        Transaction(message.addr, read_size=message.len), 1 + message.len
+                    )
+                    ctypes.memmove(message.buf, reply, message.len)
+                else:
+                    self.line.transfer(
+                        Transaction(message.addr, bytes(message)), 1 + message.len
+                    )
+
+
+class Simulation:
+    """Simulated boards on simulated buses. While the simulation runs, the host module's
+    transport opens SimulatedSMBus handles instead of the linux i2c devices, so MultiLed
+    drives the boards in process:
+
+        simulation = Simulation()
+        device = simulation.add_device(1, 0x40)
+        with simulation:
+            led = MultiLed.new(config, {})
+
+    bus_speed is in Hz, 0 transfers without taking any bus time.
+    """
+
+    def __init__(self, bus_speed: int = DEFAULT_BUS_SPEED) -> None:
+        self.bus_speed = bus_speed
+        self.lines: Dict[int, BusLine] = {}
+        self.transport = None
+        self.smbus = None
+
+    def line(self, bus: int) -> BusLine:
+        if bus not in self.lines:
+            self.lines[bus] = BusLine(self.bus_speed)
+        return self.lines[bus]
+
+    def add_device(self, bus: int = 1, address: int = 0x40, **kwargs) -> SimulatedDevice:
+        """Put a board on a bus, see SimulatedDevice for the keyword arguments."""
+        device = SimulatedDevice(address, **kwargs)
+        self.line(bus).devices[address] = device
+        return device
+
+    def device(self, bus: int, address: int) -> Optional[SimulatedDevice]:
+        line = self.lines.get(bus)
+        return line.devices.get(address) if line is not None else None
+
+    def devices(self) -> Dict[Tuple[int, int], SimulatedDevice]:
+        return {
+            (bus, address): device
+            for bus, line in self.lines.items()
+            for address, device in line.devices.items()
+        }
+
+    def open_bus(self, bus: int) -> SimulatedSMBus:
+        return SimulatedSMBus(self.line(bus))
+
+    def stats(self) -> Dict[int, dict]:
+        return {bus: line.stats() for bus, line in self.lines.items()}
+
+    def start(self) -> None:
+        import transport
+
+        for device in self.devices().values():
+            device.start()
+        self.transport = transport
+        self.smbus = transport.SMBus
+        transport.SMBus = self.open_bus
+
+    def stop(self) -> None:
+        if self.transport is not None:
+            self.transport.SMBus = self.smbus
+            self.transport = None
+        for device in self.devices().values():
+            device.stop()
+
+    def __enter__(self) -> "Simulation":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
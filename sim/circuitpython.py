@@ -0,0 +1,265 @@
+"""Stand-ins for the CircuitPython modules rp2040i2c.py imports that only exist on the
+board. The bundle libraries it uses (adafruit_led_animation and adafruit_ticks) are pure
+Python and run unchanged on CPython, so the simulated firmware draws its animations with
+the real ones, see sim/requirements.txt.
+
+The fakes are plain module objects put in sys.modules while the firmware is loaded, so
+nothing named board or micropython ends up on the host's import path.
+"""
+
+import gc
+import sys
+import threading
+import time
+import types
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Iterator, Optional, Tuple
+
+
+def colorwheel(position) -> int:
+    """rainbowio.colorwheel: a color from a 0-255 position on the color wheel."""
+    position = int(position) % 256
+    if position < 85:
+        return (255 - position * 3) << 16 | (position * 3) << 8
+    if position < 170:
+        position -= 85
+        return (position * 3) << 8 | (255 - position * 3)
+    position -= 170
+    return (position * 3) << 16 | (255 - position * 3)
+
+
+def _rgb(color) -> Tuple[int, int, int]:
+    if isinstance(color, int):
+        return (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF
+    return int(color[0]), int(color[1]), int(color[2])
+
+
+class NeoPxl8:
+    """adafruit_neopxl8.NeoPxl8 without the PIO state machine. Pixels are kept in a
+    bytearray of rgb triples; show() copies it, which is what the strands would display,
+    and keeps the last history_size shown frames."""
+
+    # set by the simulated device before it loads the firmware
+    history_size = 0
+
+    def __init__(
+        self,
+        data0,
+        n: int,
+        *,
+        num_strands: int = 8,
+        brightness: float = 1.0,
+        auto_write: bool = True,
+        **kwargs,
+    ) -> None:
+        self.n = n
+        self.num_strands = num_strands
+        self.brightness = brightness
+        self.auto_write = auto_write
+        self.buffer = bytearray(n * 3)
+        self.shown = bytes(self.buffer)
+        self.shown_at = 0.0
+        self.shows = 0
+        self.history: Deque[Tuple[float, bytes]] = deque(maxlen=self.history_size)
+        self.deinited = False
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __setitem__(self, index, value) -> None:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.n)
+            if isinstance(value, (bytes, bytearray, memoryview)) and step == 1:
+                # packed rgb bytes, as set_pixel_runs writes them
+                self.buffer[start * 3 : stop * 3] = value
+            else:
+                for i, color in zip(range(start, stop, step), value):
+                    self.buffer[i * 3 : i * 3 + 3] = bytes(_rgb(color))
+        else:
+            if index < 0:
+                index += self.n
+            if not 0 <= index < self.n:
+                raise IndexError("pixel index out of range")
+            self.buffer[index * 3 : index * 3 + 3] = bytes(_rgb(value))
+        if self.auto_write:
+            self.show()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.n))]
+        if index < 0:
+            index += self.n
+        return tuple(self.buffer[index * 3 : index * 3 + 3])
+
+    def fill(self, color) -> None:
+        self.buffer[:] = bytes(_rgb(color)) * self.n
+        if self.auto_write:
+            self.show()
+
+    def show(self) -> None:
+        self.shown = bytes(self.buffer)
+        self.shown_at = time.perf_counter()
+        self.shows += 1
+        if self.history.maxlen:
+            self.history.append((self.shown_at, self.shown))
+
+    def output(self) -> bytes:
+        """The last shown frame scaled by the brightness, as sent to the strands."""
+        return bytes(int(value * self.brightness) for value in self.shown)
+
+    def deinit(self) -> None:
+        self.deinited = True
+
+
+class I2CTargetRequest:
+    """One transaction addressed to the simulated board. Reading a write transaction
+    takes the bytes the host wrote, running on into the transactions queued after it like
+    the peripheral's receive fifo, until the host stops writing."""
+
+    def __init__(self, target: "I2CTarget", transaction: "Transaction") -> None:
+        self.target = target
+        self.transaction = transaction
+        self.address = transaction.address
+        self.is_read = transaction.is_read
+        self.is_restart = False
+
+    def __enter__(self) -> "I2CTargetRequest":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.target.finish()
+
+    def read(self, n: int = -1, ack: bool = True) -> bytes:
+        return self.target.read(n)
+
+    def write(self, buffer) -> int:
+        self.transaction.reply = bytes(buffer)
+        return len(buffer)
+
+    def ack(self, ack: bool = True) -> None:
+        pass
+
+
+class Transaction:
+    def __init__(self, address: int, data: bytes = b"", read_size: int = 0) -> None:
+        self.address = address
+        self.data = data
+        self.is_read = read_size > 0
+        self.read_size = read_size
+        self.pos = 0
+        self.reply = b""
+        self.done = threading.Event()
+
+
+class I2CTarget:
+    """i2ctarget.I2CTarget fed by SimulatedSMBus instead of the i2c peripheral."""
+
+    # how long request() waits for the host before telling the loop nothing is pending
+    IDLE_WAIT = 0.0005
+
+    def __init__(self, scl=None, sda=None, addresses=(), smbus: bool = False) -> None:
+        self.addresses = tuple(addresses)
+        self.condition = threading.Condition()
+        self.pending: Deque[Transaction] = deque()
+        self.current: Optional[Transaction] = None
+        self.closed = False
+
+    def __enter__(self) -> "I2CTarget":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.deinit()
+
+    def deinit(self) -> None:
+        with self.condition:
+            self.closed = True
+            for transaction in self.pending:
+                transaction.done.set()
+            self.pending.clear()
+
+    def submit(self, transaction: Transaction) -> None:
+        # called on the host's i2c worker threads
+        with self.condition:
+            if self.closed:
+                raise OSError(121, "Remote I/O error")
+            self.pending.append(transaction)
+            self.condition.notify_all()
+
+    def request(self, timeout: float = -1.0) -> Optional[I2CTargetRequest]:
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(self.IDLE_WAIT)
+            if not self.pending:
+                return None
+            self.current = self.pending.popleft()
+            return I2CTargetRequest(self, self.current)
+
+    def read(self, n: int) -> bytes:
+        """Take up to n bytes the host wrote. Reads stay within one transaction and move
+        on to the next write once the current one is used up."""
+        with self.condition:
+            transaction = self.current
+            if transaction.pos >= len(transaction.data):
+                if not self.pending:
+                    self.condition.wait(self.IDLE_WAIT)
+                if not self.pending or self.pending[0].is_read:
+                    return b""
+                transaction = self.current = self.pending.popleft()
+            end = len(transaction.data) if n < 0 else transaction.pos + n
+            data = transaction.data[transaction.pos : end]
+            transaction.pos += len(data)
+            if transaction.pos >= len(transaction.data):
+                # every byte is in the fifo, so the host's write is over
+                transaction.done.set()
+            return data
+
+    def finish(self) -> None:
+        with self.condition:
+            # a write the firmware gave up on part way is over as well
+            self.current.done.set()
+            self.current = None
+
+
+def gc_module() -> types.ModuleType:
+    """gc with CircuitPython's mem_free and mem_alloc. The simulated board has no fixed
+    heap, so they report 0."""
+    module = types.ModuleType("gc")
+    for name in ("collect", "enable", "disable", "isenabled"):
+        setattr(module, name, getattr(gc, name))
+    module.mem_free = lambda: 0
+    module.mem_alloc = lambda: 0
+    return module
+
+
+@contextmanager
+def installed() -> Iterator[None]:
+    """Make the board only modules importable for as long as the block runs."""
+    board = types.ModuleType("board")
+    board.NEOPIXEL0 = "NEOPIXEL0"
+    board.SCL = "SCL"
+    board.SDA = "SDA"
+    micropython = types.ModuleType("micropython")
+    micropython.const = lambda value: value
+    rainbowio = types.ModuleType("rainbowio")
+    rainbowio.colorwheel = colorwheel
+    i2ctarget = types.ModuleType("i2ctarget")
+    i2ctarget.I2CTarget = I2CTarget
+    i2ctarget.I2CTargetRequest = I2CTargetRequest
+    neopxl8 = types.ModuleType("adafruit_neopxl8")
+    neopxl8.NeoPxl8 = NeoPxl8
+
+    fakes = {
+        module.__name__: module
+        for module in (board, micropython, rainbowio, i2ctarget, neopxl8)
+    }
+    previous = {name: sys.modules.get(name) for name in fakes}
+    sys.modules.update(fakes)
+    try:
+        yield
+    finally:
+        for name, module in previous.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
@@ -0,0 +1,160 @@
+import __future__
+import os
+import threading
+import time
+import types
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from sim import circuitpython
+
+FIRMWARE = os.path.join(os.path.dirname(__file__), "..", "2040_scripts", "rp2040i2c.py")
+# most handled frames kept in SimulatedDevice.frames
+DEFAULT_FRAME_LOG_SIZE = 1000
+
+_load_lock = threading.Lock()
+_loaded = 0
+
+
+def load_firmware(settings: Optional[Dict[str, object]] = None, verbose: bool = False):
+    """Load a new copy of rp2040i2c.py with the simulated CircuitPython modules. Loading
+    runs everything but the main loop, so the board isn't configured yet.
+
+    Args:
+        settings: settings.toml values, e.g. {"MULTI_LED_FPS": 30}
+        verbose: let the firmware print to stdout
+    """
+    global _loaded
+    with _load_lock:
+        _loaded += 1
+        firmware = types.ModuleType(f"rp2040i2c_sim{_loaded}")
+        firmware.__file__ = FIRMWARE
+        with open(FIRMWARE) as f:
+            # CircuitPython never evaluates annotations, some name modules the firmware
+            # doesn't import
+            code = compile(
+                f.read(), FIRMWARE, "exec", flags=__future__.annotations.compiler_flag
+            )
+        # os.getenv stands in for settings.toml while the firmware is loaded
+        settings = {"MULTI_LED_VERBOSE": int(verbose), **(settings or {})}
+        settings = {name: str(value) for name, value in settings.items()}
+        previous = {name: os.environ.get(name) for name in settings}
+        os.environ.update(settings)
+        try:
+            with circuitpython.installed():
+                exec(code, firmware.__dict__)
+        finally:
+            for name, value in previous.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+    # CPython's gc is imported under the same name, it lacks mem_free
+    firmware.gc = circuitpython.gc_module()
+    if not verbose:
+        firmware.print = lambda *args, **kwargs: None
+    return firmware
+
+
+class SimulatedDevice:
+    """A copy of rp2040i2c.py running its main loop on a thread, with a simulated
+    I2CTarget and NeoPxl8. Every device loads its own copy of the firmware module, so
+    several boards can share a process.
+
+    Args:
+        settings: settings.toml values, e.g. {"MULTI_LED_FPS": 30}
+        history_size: how many shown frames the NeoPxl8 keeps in pixels.history
+        verbose: let the firmware print to stdout
+        scene_file: where persisted scenes are written, they are only kept in memory if
+            this is None
+    """
+
+    def __init__(
+        self,
+        address: int = 0x40,
+        settings: Optional[Dict[str, object]] = None,
+        history_size: int = 0,
+        frame_log_size: int = DEFAULT_FRAME_LOG_SIZE,
+        verbose: bool = False,
+        scene_file: Optional[str] = None,
+    ) -> None:
+        self.address = address
+        self.settings = settings or {}
+        self.history_size = history_size
+        self.verbose = verbose
+        self.scene_file = scene_file
+        # (sequence, command, ok, time.perf_counter() before and after applying) of
+        # handled frames
+        self.frames: Deque[tuple] = deque(maxlen=frame_log_size)
+        self.firmware = None
+        self.target: Optional[circuitpython.I2CTarget] = None
+        self.thread: Optional[threading.Thread] = None
+        self.running = False
+        self.error: Optional[BaseException] = None
+
+    @property
+    def pixels(self) -> Optional[circuitpython.NeoPxl8]:
+        """The firmware's NeoPxl8, None until the board has been configured."""
+        display = self.firmware.pixel_display if self.firmware else None
+        return display.pixels if display is not None else None
+
+    def load(self) -> None:
+        firmware = load_firmware(self.settings, self.verbose)
+        firmware.NeoPxl8 = type(
+            "NeoPxl8", (circuitpython.NeoPxl8,), {"history_size": self.history_size}
+        )
+        # the firmware loaded its scenes from the board's root directory on import
+        firmware.SCENE_FILE = self.scene_file or os.devnull
+        firmware.scenes = firmware.SceneStore()
+        if self.scene_file is not None:
+            firmware.scenes.load()
+
+        apply_command = firmware.apply_command
+
+        def record(command: dict) -> bool:
+            ok = False
+            started = time.perf_counter()
+            try:
+                ok = apply_command(command)
+                return ok
+            finally:
+                self.frames.append(
+                    (
+                        firmware.receiver.sequence,
+                        command,
+                        ok,
+                        started,
+                        time.perf_counter(),
+                    )
+                )
+
+        firmware.apply_command = record
+        self.firmware = firmware
+
+    def start(self) -> None:
+        if self.firmware is None:
+            self.load()
+        self.target = circuitpython.I2CTarget(addresses=(self.address,))
+        self.running = True
+        self.thread = threading.Thread(
+            target=self._run, name=f"sim-0x{self.address:02x}", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.target is not None:
+            self.target.deinit()
+
+    def _run(self) -> None:
+        try:
+            while self.running:
+                self.firmware.poll(self.target)
+        except BaseException as e:
+            # code.py would have stopped here, so the board stops answering
+            self.error = e
+            self.running = False
+            self.target.deinit()
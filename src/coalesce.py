@@ -0,0 +1,84 @@
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+# keys that switch a strand between animation, sequence and manual pixel mode
+MODE_KEYS = ("set_animation", "sequence", "set_pixel_colors")
+
+
+def is_strand_command(command) -> bool:
+    """Strand commands map strand indexes to param dicts, like the ones in commands.json."""
+    return len(command) > 0 and all(
+        str(key).isdigit() and isinstance(params, dict)
+        for key, params in command.items()
+    )
+
+
+def merge_params(old: dict, new: dict) -> dict:
+    """Merge a newer param dict for a strand into an older unsent one, so that sending the
+    result leaves the strand in the same state as sending both in order."""
+    merged = dict(old)
+    if "set_pixel_colors" in new:
+        pixels = {}
+        if isinstance(merged.get("set_pixel_colors"), dict):
+            pixels.update(merged["set_pixel_colors"])
+        pixels.update(new["set_pixel_colors"])
+        merged.pop("set_animation", None)
+        merged.pop("sequence", None)
+        merged["set_pixel_colors"] = pixels
+    elif "set_animation" in new or "sequence" in new:
+        for key in MODE_KEYS:
+            merged.pop(key, None)
+    for key, value in new.items():
+        if key != "set_pixel_colors":
+            merged[key] = value
+    return merged
+
+
+class CommandCoalescer:
+    """Keeps a pending command slot per strand. Commands that arrive before the pending
+    batch is picked up by the i2c worker are merged into it (last writer wins), so a
+    burst of updates to the same strand goes out as a single transaction.
+
+    schedule is called once per batch with a function that returns the merged message;
+    the worker calls that function when it is ready to send, which closes the batch.
+    """
+
+    def __init__(self, schedule: Callable[[Callable[[], dict]], Future]) -> None:
+        self.schedule = schedule
+        self.lock = threading.Lock()
+        self.batch: Optional[Dict[str, dict]] = None
+        self.future: Optional[Future] = None
+        self.merged = 0
+
+    def add(self, command) -> Future:
+        """Merge a strand command into the pending batch, opening a new one if needed.
+
+        Returns:
+            Future: resolves once the batch containing the command has been sent
+        """
+        with self.lock:
+            if self.batch is None:
+                batch: Dict[str, dict] = {}
+                self.future = self.schedule(lambda: self._take(batch))
+                self.batch = batch
+            for key, params in command.items():
+                strand = str(key)
+                if strand in self.batch:
+                    self.batch[strand] = merge_params(self.batch[strand], params)
+                    self.merged += 1
+                else:
+                    self.batch[strand] = dict(params)
+            return self.future
+
+    def seal(self) -> None:
+        """Stop merging into the pending batch, so commands added afterwards are sent after
+        anything queued in between."""
+        with self.lock:
+            self.batch = None
+
+    def _take(self, batch: Dict[str, dict]) -> dict:
+        with self.lock:
+            if self.batch is batch:
+                self.batch = None
+            return batch
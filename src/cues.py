@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
+
+from viam import logging
+
+from coalesce import is_strand_command, merge_params
+
+LOG = logging.getLogger(__name__)
+
+# cues closer together than this are sent in the same transaction
+DEFAULT_CUE_TICK = 0.01
+
+
+def parse_cues(cues) -> List[Tuple[float, int, dict]]:
+    """Read cues given as [time offset in seconds, strand, params] lists.
+
+    Raises:
+        ValueError: a cue isn't of that form
+    """
+    parsed = []
+    for cue in cues:
+        if not isinstance(cue, (list, tuple)) or len(cue) != 3:
+            raise ValueError(f"cue {cue} must be [time offset, strand, params]")
+        offset, strand, params = cue
+        if not is_strand_command({str(int(strand)): params}):
+            raise ValueError(f"cue {cue} must have a params mapping")
+        if float(offset) < 0:
+            raise ValueError(f"cue {cue} has a negative time offset")
+        parsed.append((float(offset), int(strand), params))
+    return parsed
+
+
+def group_cues(
+    cues: List[Tuple[float, int, dict]], tick: float
+) -> List[Tuple[float, dict]]:
+    """Merge cues within tick of the first cue of their group into one strand command,
+    in the order they were given for cues on the same strand. Groups are sent at the
+    offset of their first cue, so no cue is sent early and none later than tick.
+
+    Returns:
+        list of (time offset, strand command) sorted by time offset
+    """
+    groups: List[Tuple[float, Dict[str, dict]]] = []
+    for offset, strand, params in sorted(cues, key=lambda cue: cue[0]):
+        if not groups or offset - groups[-1][0] >= tick:
+            groups.append((offset, {}))
+        command = groups[-1][1]
+        key = str(strand)
+        if key in command:
+            command[key] = merge_params(command[key], params)
+        else:
+            command[key] = dict(params)
+    return groups
+
+
+class CueTimeline:
+    """Plays prepared cue groups against the clock. Each group is queued early by the
+    measured latency of the boards it goes to, so it reaches them at its time offset,
+    and how late or early it was written is recorded per cue group.
+
+    groups are (time offset, [(target, frame, local strands)]) as returned by
+    MultiLed.prepare_scene for every grouped command.
+    """
+
+    def __init__(self, groups: List[Tuple[float, list]]) -> None:
+        self.groups = groups
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.sent = 0
+            self.lateness: List[float] = []
+
+    async def play(self, delay: float = 0.0) -> None:
+        self.reset_stats()
+        start = time.perf_counter() + delay
+        for offset, prepared in self.groups:
+            due = start + offset
+            lead = max(target.latency for target, _, _ in prepared)
+            await asyncio.sleep(max(0.0, due - lead - time.perf_counter()))
+            for target, frame, strands in prepared:
+                target.send_prepared(
+                    frame, strands, lambda written, due=due: self.record(written - due)
+                ).add_done_callback(self.log_failure)
+            with self.lock:
+                self.sent += 1
+
+    def record(self, lateness: float) -> None:
+        # called on the i2c worker threads
+        with self.lock:
+            self.lateness.append(lateness)
+
+    def log_failure(self, future: Future) -> None:
+        if future.exception() is not None:
+            LOG.error(f"failed to send cue over i2c: {future.exception()}")
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lateness = sorted(self.lateness)
+            sent = self.sent
+        stats = {"groups": len(self.groups), "sent": sent, "written": len(lateness)}
+        if lateness:
+            stats.update(
+                {
+                    "lateness_avg_ms": sum(lateness) / len(lateness) * 1000,
+                    "lateness_min_ms": lateness[0] * 1000,
+                    "lateness_max_ms": lateness[-1] * 1000,
+                    "lateness_p95_ms": lateness[int(len(lateness) * 0.95)] * 1000,
+                }
+            )
+        return stats
@@ -1,6 +1,8 @@
 import asyncio
-from typing import ClassVar, Final, Mapping, Sequence, Optional
-from smbus2 import SMBus, i2c_msg
+import base64
+import time
+from typing import ClassVar, Final, List, Mapping, Sequence, Optional, Tuple
+from concurrent.futures import Future
 
 from typing_extensions import Self
 from viam.components.generic import *
@@ -10,22 +12,62 @@ from viam.proto.common import ResourceName
 from viam.resource.base import ResourceBase
 from viam.resource.easy_resource import EasyResource
 from viam.resource.types import Model, ModelFamily
-from viam.utils import ValueTypes
+from viam.utils import ValueTypes, struct_to_dict
 from viam import logging
 
-import json
-import io
+from protocol import ENCODING_BINARY, ENCODING_JSON, ENCODING_TOKENS
+from renderer import HostRenderer, np
+from cues import DEFAULT_CUE_TICK, CueTimeline, group_cues, parse_cues
+from scenes import DEFAULT_SCENE_CACHE_SIZE, SceneLibrary
+from stream import frame_bytes
+from target import LedTarget, write_together
+from transport import (
+    BUSES,
+    DEFAULT_ACK_TIMEOUT,
+    DEFAULT_QUEUE_SIZE,
+    TRANSFER_BLOCK,
+    TRANSFER_MODES,
+    gather_futures,
+)
+from coalesce import MODE_KEYS, is_strand_command
+from validation import CommandValidator
 
 LOG = logging.getLogger(__name__)
-MESSAGE_CHUNK_SIZE = 32
 
+# values accepted by the optional protocol attribute
+PROTOCOLS = {"binary": ENCODING_BINARY, "json": ENCODING_JSON, "tokens": ENCODING_TOKENS}
+DEFAULT_BUS = 1
+# frame rate of strands rendered on the host, see the render strand param
+DEFAULT_HOST_FPS = 30
+# values accepted by the render strand param
+RENDER_HOST = "host"
+RENDER_DEVICE = "device"
+# strand params only a board can apply, the host renderer runs single animations
+HOST_UNSUPPORTED_KEYS = ("set_pixel_colors", "sequence")
+# bus workers being released off the event loop, see release_worker
+_releasing = set()
 
-# used to divide a byte string into 32 byte chunks to send over i2c and then put back together on the read side
-def divide_chunks(l, n):
 
-    # looping till length l
-    for i in range(0, len(l), n):
-        yield l[i : i + n]
+def parse_targets(config: ComponentConfig) -> List[Tuple[int, int, int]]:
+    """Read the boards to drive from the config, either a targets list or the single
+    board given by the bus and address attributes.
+
+    Returns:
+        list of (bus number, address, number of strands) in strand index order
+    """
+    attributes = struct_to_dict(config.attributes)
+    num_strands = int(attributes["num_strands"])
+    targets = attributes.get("targets") or [
+        {"bus": attributes.get("bus", DEFAULT_BUS), "address": attributes["address"]}
+    ]
+    return [
+        (
+            int(target.get("bus", DEFAULT_BUS)),
+            int(target["address"], 16),
+            int(target.get("num_strands", num_strands)),
+        )
+        for target in targets
+    ]
 
 
 class MultiLed(Generic, EasyResource):
@@ -33,11 +75,19 @@ class MultiLed(Generic, EasyResource):
         ModelFamily("vijayvuyyuru", "multi-led"), "multi-led"
     )
 
-    bus = None
+    targets: List[LedTarget] = []
     strand_length = 0
     num_strands = 0
     brightness = 0
-    address = 0
+    host_fps = DEFAULT_HOST_FPS
+    renderer: Optional[HostRenderer] = None
+    render_task: Optional[asyncio.Task] = None
+    scenes: Optional[SceneLibrary] = None
+    cues: Optional[CueTimeline] = None
+    cue_task: Optional[asyncio.Task] = None
+    validator = CommandValidator(0, 0)
+    # boards holding animations built by arm, waiting for fire
+    armed: List[LedTarget] = []
 
     @classmethod
     def new(
@@ -81,10 +131,89 @@ class MultiLed(Generic, EasyResource):
                 "A brightness attribute is required for multi led component component. Must be a float like 0.2 for 20% brightness"
             )
 
-        if "address" not in config.attributes.fields:
+        # an empty targets list falls back to the address attribute like a missing one
+        targets = []
+        if "targets" in config.attributes.fields:
+            targets = config.attributes.fields["targets"].list_value.values
+        if targets:
+            for target in targets:
+                if "address" not in target.struct_value.fields:
+                    raise Exception(
+                        "Every entry of the targets attribute for multi led component needs an address of format 0xADDRESS"
+                    )
+        elif "address" not in config.attributes.fields:
+            raise Exception(
+                "A address attribute is required for multi led component unless targets lists the boards. It should be of format 0xADDRESS"
+            )
+
+        if (
+            "protocol" in config.attributes.fields
+            and config.attributes.fields["protocol"].string_value not in PROTOCOLS
+        ):
+            raise Exception(
+                f"The protocol attribute for multi led component must be one of {list(PROTOCOLS)}"
+            )
+
+        if (
+            "transfer_mode" in config.attributes.fields
+            and config.attributes.fields["transfer_mode"].string_value
+            not in TRANSFER_MODES
+        ):
+            raise Exception(
+                f"The transfer_mode attribute for multi led component must be one of {list(TRANSFER_MODES)}"
+            )
+
+        if (
+            "host_fps" in config.attributes.fields
+            and config.attributes.fields["host_fps"].number_value <= 0
+        ):
+            raise Exception(
+                "The host_fps attribute for multi led component must be a positive number"
+            )
+
+        if (
+            "queue_size" in config.attributes.fields
+            and config.attributes.fields["queue_size"].number_value < 1
+        ):
+            raise Exception(
+                "The queue_size attribute for multi led component must be at least 1"
+            )
+
+        if (
+            "transfer_size" in config.attributes.fields
+            and config.attributes.fields["transfer_size"].number_value < 0
+        ):
+            raise Exception(
+                "The transfer_size attribute for multi led component must be 0 or a positive number of bytes"
+            )
+
+        if (
+            "scene_cache_size" in config.attributes.fields
+            and config.attributes.fields["scene_cache_size"].number_value < 0
+        ):
             raise Exception(
-                "A address attribute is required for multi led component. It should be of format 0xADDRESS"
+                "The scene_cache_size attribute for multi led component must be 0 or a positive number"
             )
+
+        if "scenes" in config.attributes.fields:
+            scenes = struct_to_dict(config.attributes)["scenes"]
+            if not isinstance(scenes, dict):
+                raise Exception(
+                    "The scenes attribute for multi led component must map scene names to strand commands"
+                )
+            # scenes are checked like commands sent with do_command, against the
+            # configured strands
+            validator = CommandValidator(
+                sum(target[2] for target in parse_targets(config)),
+                int(config.attributes.fields["strand_length"].number_value),
+            )
+            for name, command in scenes.items():
+                try:
+                    validator.validate_prepared_command(command)
+                except ValueError as e:
+                    raise Exception(
+                        f"Invalid scene {name} in the scenes attribute for multi led component: {e}"
+                    )
         return []
 
     def reconfigure(
@@ -96,32 +225,106 @@ class MultiLed(Generic, EasyResource):
             config (ComponentConfig): The new configuration
             dependencies (Mapping[ResourceName, ResourceBase]): Any dependencies (both implicit and explicit)
         """
-        num_strands: int = int(config.attributes.fields["num_strands"].number_value)
         strand_length: int = int(config.attributes.fields["strand_length"].number_value)
         brightness: float = config.attributes.fields["brightness"].number_value
-        address_hex_string = config.attributes.fields["address"].string_value
-        LOG.info(f"address hex string: {address_hex_string}")
-        address = int(address_hex_string, 16)
-        LOG.info(f"converted address: {address}")
-
-        if self.bus is not None:
-            self.bus.close()
-
-        self.bus = SMBus(1)
-        pixel_config = {
-            "reconfigure": {
-                "num_strands": num_strands,
-                "strand_length": strand_length,
-                "brightness": brightness,
-            }
+        protocol = "binary"
+        if "protocol" in config.attributes.fields:
+            protocol = config.attributes.fields["protocol"].string_value
+        queue_size = DEFAULT_QUEUE_SIZE
+        if "queue_size" in config.attributes.fields:
+            queue_size = int(config.attributes.fields["queue_size"].number_value)
+        transfer_mode = TRANSFER_BLOCK
+        if "transfer_mode" in config.attributes.fields:
+            transfer_mode = config.attributes.fields["transfer_mode"].string_value
+        transfer_size = 0
+        if "transfer_size" in config.attributes.fields:
+            transfer_size = int(config.attributes.fields["transfer_size"].number_value)
+        ack_timeout = DEFAULT_ACK_TIMEOUT
+        if "ack_timeout_ms" in config.attributes.fields:
+            ack_timeout = config.attributes.fields["ack_timeout_ms"].number_value / 1000
+        host_fps = DEFAULT_HOST_FPS
+        if "host_fps" in config.attributes.fields:
+            host_fps = config.attributes.fields["host_fps"].number_value
+        scene_cache_size = DEFAULT_SCENE_CACHE_SIZE
+        if "scene_cache_size" in config.attributes.fields:
+            scene_cache_size = int(
+                config.attributes.fields["scene_cache_size"].number_value
+            )
+
+        # boards that keep their bus, address and strands keep their target, and with it
+        # their bus worker, sequence numbers and pending commands, even when boards before
+        # them change and their combined strand indexes move
+        old_targets = {
+            (target.worker.bus_number, target.address): target for target in self.targets
         }
+        targets = []
+        first_strand = 0
+        moved = False
+        for bus_number, address, num_strands in parse_targets(config):
+            target = old_targets.pop((bus_number, address), None)
+            if target is not None and (
+                target.num_strands != num_strands or target.strand_length != strand_length
+            ):
+                # the board's strands change, its coalescer and streamer go with them
+                old_targets[(bus_number, address)] = target
+                target = None
+            if target is None:
+                LOG.info(f"driving board at address {address} on bus {bus_number}")
+                # acquire the new buses before releasing the old ones so shared workers
+                # stay up
+                target = LedTarget(
+                    BUSES.acquire(bus_number, queue_size),
+                    address,
+                    first_strand,
+                    num_strands,
+                    strand_length,
+                    PROTOCOLS[protocol],
+                    transfer_mode,
+                    transfer_size,
+                    ack_timeout,
+                )
+            else:
+                if target.first_strand != first_strand:
+                    target.first_strand = first_strand
+                    moved = True
+                target.encoding = PROTOCOLS[protocol]
+                target.transfer_mode = transfer_mode
+                target.transfer_size = transfer_size
+                target.ack_timeout = ack_timeout
+            targets.append(target)
+            first_strand += num_strands
+        for target in old_targets.values():
+            release_worker(target.worker)
 
-        self.num_strands = num_strands
-        self.strand_length = self.strand_length
+        self.targets = targets
+        self.num_strands = first_strand
+        self.strand_length = strand_length
         self.brightness = brightness
-        self.address = address
+        self.host_fps = host_fps
+        self.validator = CommandValidator(self.num_strands, strand_length)
+        messages = [(target, target.config_message(brightness)) for target in targets]
+        if old_targets or moved or any(
+            message is not None and "reconfigure" in message for _, message in messages
+        ):
+            # host rendered strands and cues are kept by combined strand index, and the
+            # boards that are reset below take every strand back
+            self.stop_rendering()
+            self.renderer = None
+            # cues and armed animations are for the old boards
+            self.armed = []
+            self.stop_cues()
+            self.cues = None
+        self.scenes = None
+        if "scenes" in config.attributes.fields:
+            self.scenes = SceneLibrary(
+                struct_to_dict(config.attributes)["scenes"],
+                self.prepare_scene,
+                scene_cache_size,
+            )
 
-        self.send_message(pixel_config)
+        for target, message in messages:
+            if message is not None:
+                target.configure(message, brightness).add_done_callback(log_failure)
 
     async def do_command(
         self,
@@ -130,31 +333,390 @@ class MultiLed(Generic, EasyResource):
         timeout: Optional[float] = None,
         **kwargs,
     ) -> Mapping[str, ValueTypes]:
-        LOG.info(f"value passed into do command: {command}")
-        return self.send_message(command)
-
-    def send_message(self, message):
-        byte_string = json.dumps(message).encode("utf-8")
-        chunks = divide_chunks(byte_string, MESSAGE_CHUNK_SIZE)
-        LOG.info("sent message over i2c")
-        for chunk in chunks:
-            self.bus.write_i2c_block_data(self.address, 0x00, chunk)
-        
-        # response = self.bus.read_i2c_block_data(self.address, 0x00, MESSAGE_CHUNK_SIZE)
-        # response_string = self.convert_int_list_to_string(response)
-        
-        # return {"response": response_string}
-    
-    def convert_int_list_to_string(self, int_list):
-        # Convert list of integers to bytes
-        byte_data = bytes(int_list)
-        
-        # Decode bytes to string, stopping at null terminators
-        # The 'utf-8' encoding is commonly used, but you might need another one depending on your data
-        return byte_data.decode('utf-8').rstrip('\x00')
+        # formatted only when debug logging is on, commands can carry whole frames
+        LOG.debug("value passed into do command: %s", command)
+        if "stream_frame" in command:
+            # frames come in as base64 encoded RGB bytes
+            frame = base64.b64decode(command["stream_frame"])
+            statuses = await asyncio.wrap_future(self.stream_frame(frame))
+            return self.combine(
+                self.targets,
+                [
+                    {**(status or {}), **target.streamer.stats()}
+                    for target, status in zip(self.targets, statuses)
+                ],
+            )
+        if isinstance(command.get("play_scene"), str):
+            # scenes from the scenes attribute, numbered scenes are stored on the boards
+            scene = self.play_scene(command["play_scene"])
+            statuses = await asyncio.wrap_future(
+                gather_futures([future for _, future in scene])
+            )
+            return self.combine([target for target, _ in scene], statuses)
+        if "arm" in command:
+            self.validator.validate(command)
+            split = self.split_strand_command(command["arm"])
+            self.armed = list(split)
+            futures = [target.send_message({"arm": split[target]}) for target in self.armed]
+            statuses = await asyncio.wrap_future(gather_futures(futures))
+            return self.combine(self.armed, statuses)
+        if "fire" in command:
+            return await self.fire()
+        if "load_cues" in command:
+            return self.load_cues(command_options(command, "load_cues"))
+        if "start_cues" in command:
+            if self.cues is None:
+                raise ValueError("no cues loaded")
+            self.stop_cues()
+            self.cue_task = asyncio.create_task(
+                self.cues.play(
+                    float(command_options(command, "start_cues").get("delay", 0))
+                )
+            )
+            return {}
+        if "stop_cues" in command:
+            self.stop_cues()
+            return {}
+        if "get_cue_stats" in command:
+            return self.cues.stats() if self.cues is not None else {}
+        if "get_stats" in command:
+            return self.get_stats(
+                bool(command_options(command, "get_stats").get("reset", False))
+            )
+        if "get_frame_timing" in command:
+            timings = await asyncio.wrap_future(
+                gather_futures([target.read_timing() for target in self.targets])
+            )
+            return self.combine(self.targets, timings)
+        if "get_telemetry" in command:
+            telemetry = await asyncio.wrap_future(
+                gather_futures([target.read_telemetry() for target in self.targets])
+            )
+            return self.combine(self.targets, telemetry)
+        # rejected here instead of on the boards, where they would only show up in
+        # the console
+        self.validator.validate(command)
+        if is_strand_command(command):
+            command = self.render_on_host(command)
+            if not command:
+                return {}
+            # updates to a strand that is still waiting to be sent are merged into it
+            split = self.split_strand_command(command)
+            targets = list(split)
+            futures = [target.add_command(split[target]) for target in targets]
+        else:
+            targets = self.targets
+            futures = [
+                target.send_message(self.message_for(target, command))
+                for target in targets
+            ]
+        statuses = await asyncio.wrap_future(gather_futures(futures))
+        return self.combine(targets, statuses)
+
+    def render_on_host(self, command) -> dict:
+        """Apply the strand params of host rendered strands to the host renderer. A render
+        param of "host" moves a strand to the host, "device" hands it back to its board.
+
+        Returns:
+            dict: the part of the command still meant for the boards
+        """
+        # checked for every strand first, so a bad one doesn't leave the others moved
+        on_host = {}
+        for key, params in command.items():
+            strand = int(key)
+            render = params.get("render")
+            if render not in (None, RENDER_HOST, RENDER_DEVICE):
+                raise ValueError(f"render must be {RENDER_HOST} or {RENDER_DEVICE}")
+            hosted = self.renderer is not None and strand in self.renderer.strands
+            on_host[key] = render == RENDER_HOST or (hosted and render is None)
+            if on_host[key]:
+                for name in HOST_UNSUPPORTED_KEYS:
+                    if name in params:
+                        raise ValueError(
+                            f"strand {key} is rendered on the host, which doesn't take "
+                            f"{name}. Send render {RENDER_DEVICE} with it to hand the "
+                            "strand back to its board"
+                        )
+            elif hosted and not any(name in params for name in MODE_KEYS):
+                # the board would keep showing the last streamed pixels
+                raise ValueError(
+                    f"render {RENDER_DEVICE} for strand {key} needs one of "
+                    f"{list(MODE_KEYS)} for its board to show"
+                )
+
+        remaining = {}
+        now = time.monotonic()
+        for key, params in command.items():
+            strand = int(key)
+            if on_host[key]:
+                self.render_strand(strand, params, now)
+                continue
+            hosted = self.renderer is not None and strand in self.renderer.strands
+            if hosted:
+                self.renderer.release(strand)
+            remaining[key] = {k: v for k, v in params.items() if k != "render"}
+        if self.renderer is not None and not self.renderer.strands:
+            self.stop_rendering()
+        return {key: params for key, params in remaining.items() if params}
+
+    def render_strand(self, strand: int, params: dict, now: float) -> None:
+        if np is None:
+            raise ValueError("host rendering requires numpy to be installed")
+        if self.renderer is None:
+            self.renderer = HostRenderer(self.num_strands, self.strand_length)
+        if strand not in self.renderer.strands:
+            target, local_strand = self.target_for_strand(strand)
+            # the board's animation stops showing once streamed pixels arrive
+            target.streamer.invalidate([local_strand])
+        self.renderer.update(strand, params, now)
+        if self.render_task is None or self.render_task.done():
+            self.render_task = asyncio.create_task(self.render_loop())
+
+    async def render_loop(self) -> None:
+        """Render the host strands and stream them to their boards at host_fps, until no
+        strand is rendered on the host anymore. Frames the bus can't keep up with are
+        dropped by the streamers."""
+        interval = 1 / self.host_fps
+        next_frame = time.monotonic()
+        while self.renderer is not None and self.renderer.strands:
+            frame = self.renderer.render(time.monotonic())
+            for target in self.targets:
+                strands = [
+                    strand - target.first_strand
+                    for strand in self.renderer.strands
+                    if target.first_strand
+                    <= strand
+                    < target.first_strand + target.num_strands
+                ]
+                if strands:
+                    target.stream_frame(
+                        frame[
+                            target.first_strand : target.first_strand
+                            + target.num_strands
+                        ],
+                        strands,
+                    ).add_done_callback(log_failure)
+            next_frame = max(next_frame + interval, time.monotonic())
+            await asyncio.sleep(next_frame - time.monotonic())
+
+    def stop_rendering(self) -> None:
+        if self.render_task is not None:
+            self.render_task.cancel()
+            self.render_task = None
+
+    async def fire(self) -> dict:
+        """Start the animations armed on every board together. The fire messages of boards
+        on one bus are written back to back, different buses are written in parallel.
+
+        Returns:
+            dict: the boards' statuses, each with fired_ms, how long after the first board
+                it started its animations as far as the host can tell, and skew_ms, the
+                spread between the first and last board
+        """
+        if not self.armed:
+            raise ValueError("no animations armed")
+        by_worker = {}
+        for target in self.armed:
+            target.begin_message()
+            by_worker.setdefault(target.worker, []).append(target)
+        self.armed = []
+        results = await asyncio.wrap_future(
+            gather_futures(
+                [
+                    worker.submit(
+                        lambda bus, targets=targets: write_together(
+                            bus, targets, {"fire": 0}
+                        )
+                    )
+                    for worker, targets in by_worker.items()
+                ]
+            )
+        )
+        targets = [target for targets in by_worker.values() for target in targets]
+        statuses = [status for statuses in results for status in statuses]
+        # a board starts its animations once the write has reached it and it applied it
+        fired = [
+            status.pop("written_at") + status.get("device_apply_ms", 0) / 1000
+            for status in statuses
+        ]
+        for status, fired_at in zip(statuses, fired):
+            status["fired_ms"] = (fired_at - min(fired)) * 1000
+        result = self.combine(targets, statuses)
+        result["skew_ms"] = (max(fired) - min(fired)) * 1000
+        return result
+
+    def get_stats(self, reset: bool = False) -> dict:
+        """Transport counters and latency histograms of every board, their totals and the
+        queue depth of every bus.
+
+        Args:
+            reset: start the counters, histograms and the deepest queue over afterwards
+        """
+        targets = {target.name: target.stats.snapshot() for target in self.targets}
+        totals = {
+            key: sum(stats[key] for stats in targets.values())
+            for key in ("frames", "bytes_sent", "chunks", "errors", "timeouts")
+        }
+        workers = {target.worker for target in self.targets}
+        buses = {str(worker.bus_number): worker.stats() for worker in workers}
+        if reset:
+            for target in self.targets:
+                target.stats.reset()
+            for worker in workers:
+                worker.reset_stats()
+        return {**totals, "targets": targets, "buses": buses}
+
+    def load_cues(self, request) -> dict:
+        """Group and encode a cue list, replacing the loaded one.
+
+        Args:
+            request: the cues as [time offset in seconds, strand, params] lists and
+                optionally the tick in milliseconds within which cues are batched
+        """
+        cues = parse_cues(request.get("cues", []))
+        for _, strand, params in cues:
+            self.validator.validate_prepared_command({str(strand): params})
+        tick = float(request.get("tick_ms", DEFAULT_CUE_TICK * 1000)) / 1000
+        if tick <= 0:
+            raise ValueError("tick_ms must be positive")
+        self.stop_cues()
+        self.cues = CueTimeline(
+            [
+                (offset, self.prepare_scene(command))
+                for offset, command in group_cues(cues, tick)
+            ]
+        )
+        return {"cues": len(cues), "groups": len(self.cues.groups)}
+
+    def stop_cues(self) -> None:
+        if self.cue_task is not None:
+            self.cue_task.cancel()
+            self.cue_task = None
+
+    def prepare_scene(self, command) -> list:
+        """Split a strand command by board and encode each part ahead of time, for scenes
+        from the scenes attribute and cues.
+
+        Returns:
+            list of (target, frame, local strand indexes)
+        """
+        return [
+            (target, target.prepare_message(part), [int(key) for key in part])
+            for target, part in self.split_strand_command(command).items()
+        ]
+
+    def play_scene(self, name: str) -> List[Tuple[LedTarget, Future]]:
+        if self.scenes is None or name not in self.scenes:
+            raise ValueError(f"unknown scene {name}")
+        prepared = self.scenes.get(name)
+        if self.renderer is not None:
+            for target, _, strands in prepared:
+                for strand in strands:
+                    self.renderer.release(target.first_strand + strand)
+        return [
+            (target, target.send_prepared(frame, strands))
+            for target, frame, strands in prepared
+        ]
+
+    def message_for(self, target: LedTarget, command) -> dict:
+        """Adapt a command sent to every board to one board. Scenes are keyed by combined
+        strand indexes like strand commands, so each board stores its own strands."""
+        if "store_scene" not in command:
+            return command
+        split = self.split_strand_command(command["store_scene"].get("command", {}))
+        return {
+            **command,
+            "store_scene": {**command["store_scene"], "command": split.get(target, {})},
+        }
+
+    def split_strand_command(self, command) -> dict:
+        """Split a command keyed by combined strand indexes into one command per board,
+        keyed by the board's own strand indexes."""
+        split = {}
+        for key, params in command.items():
+            target, strand = self.target_for_strand(int(key))
+            split.setdefault(target, {})[str(strand)] = params
+        return split
+
+    def target_for_strand(self, strand: int) -> Tuple[LedTarget, int]:
+        for target in self.targets:
+            if target.first_strand <= strand < target.first_strand + target.num_strands:
+                return target, strand - target.first_strand
+        raise ValueError(
+            f"strand index {strand} out of range for {self.num_strands} configured strands"
+        )
+
+    def combine(self, targets: List[LedTarget], statuses: list) -> dict:
+        """With a single board return its status as is, otherwise key statuses by board."""
+        if len(self.targets) == 1:
+            return statuses[0] or {}
+        return {
+            target.name: status or {} for target, status in zip(targets, statuses)
+        }
+
+    def stream_frame(self, frame) -> Future:
+        """Queue a full frame of num_strands x strand_length x 3 RGB bytes, either as bytes or
+        as a uint8 NumPy array, covering the strands of every board in order. Only the
+        pixels that changed since the last frame are sent, and frames submitted faster
+        than the bus can take them replace each other.
+
+        Returns:
+            Future: resolves to the list of board statuses once the frame, or a newer one,
+                has been written to every board
+        """
+        data = frame_bytes(frame)
+        strand_bytes = self.strand_length * 3
+        if len(data) != self.num_strands * strand_bytes:
+            raise ValueError(
+                f"frame has {len(data)} bytes, expected {self.num_strands * strand_bytes} "
+                f"({self.num_strands} strands x {self.strand_length} pixels x 3)"
+            )
+        return gather_futures(
+            [
+                target.stream_frame(
+                    data[
+                        target.first_strand
+                        * strand_bytes : (target.first_strand + target.num_strands)
+                        * strand_bytes
+                    ]
+                )
+                for target in self.targets
+            ]
+        )
 
     async def close(self):
-        self.bus.close()
+        self.stop_cues()
+        self.stop_rendering()
+        for target in self.targets:
+            await asyncio.to_thread(BUSES.release, target.worker)
+        self.targets = []
+
+
+def release_worker(worker) -> None:
+    """Release a bus worker without blocking the event loop, closing the last reference
+    waits for the jobs still queued on the bus."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        BUSES.release(worker)
+        return
+    # the loop only keeps weak references to tasks
+    task = loop.create_task(asyncio.to_thread(BUSES.release, worker))
+    _releasing.add(task)
+    task.add_done_callback(_releasing.discard)
+
+
+def command_options(command, name: str) -> Mapping:
+    """The options a do_command key is given as its value, e.g. {"start_cues": {}}."""
+    options = command[name]
+    if not isinstance(options, Mapping):
+        raise ValueError(f"{name} must be a mapping of options, e.g. {{}}")
+    return options
+
+
+def log_failure(future: Future) -> None:
+    if future.exception() is not None:
+        LOG.error(f"failed to send message over i2c: {future.exception()}")
 
 
 if __name__ == "__main__":
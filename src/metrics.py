@@ -0,0 +1,119 @@
+import threading
+from bisect import bisect_right
+from typing import Dict, Sequence
+
+# upper bounds of the latency buckets in microseconds, doubling from 16 us to about 2 s.
+# Slower samples go in one more bucket past the last bound.
+LATENCY_BOUNDS_US = tuple(2**i for i in range(4, 22))
+
+
+class Histogram:
+    """Counts samples in fixed buckets, so recording one costs the same however many
+    were recorded before and the memory used never grows. Percentiles are the upper
+    bound of the bucket they fall in."""
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BOUNDS_US) -> None:
+        self.bounds = tuple(bounds)
+        self.reset()
+
+    def reset(self) -> None:
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        us = seconds * 1e6
+        self.counts[bisect_right(self.bounds, us)] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound in microseconds of the bucket holding the given fraction of the
+        samples, the slowest sample for the last bucket."""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> Dict[str, object]:
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "avg_ms": self.total / self.count / 1000,
+            "max_ms": self.max / 1000,
+            "p50_ms": self.percentile(0.5) / 1000,
+            "p95_ms": self.percentile(0.95) / 1000,
+            "p99_ms": self.percentile(0.99) / 1000,
+            # non-empty buckets by upper bound in ms, "inf" for the overflow bucket
+            "buckets": {
+                (f"{self.bounds[i] / 1000:g}" if i < len(self.bounds) else "inf"): count
+                for i, count in enumerate(self.counts)
+                if count
+            },
+        }
+
+
+class TransportStats:
+    """Counters and latency histograms for the frames written to one board. Frames are
+    written from the bus's worker thread, but prepared ones are encoded on the event
+    loop, so updates take a lock."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.encode = Histogram()
+        self.transmit = Histogram()
+        self.ack = Histogram()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.frames = 0
+            self.bytes_sent = 0
+            self.chunks = 0
+            self.errors = 0
+            self.timeouts = 0
+            self.encode.reset()
+            self.transmit.reset()
+            self.ack.reset()
+
+    def record_encode(self, seconds: float) -> None:
+        with self.lock:
+            self.encode.record(seconds)
+
+    def record_write(self, size: int, chunks: int, seconds: float) -> None:
+        with self.lock:
+            self.frames += 1
+            self.bytes_sent += size
+            self.chunks += chunks
+            self.transmit.record(seconds)
+
+    def record_ack(self, status: str, seconds: float) -> None:
+        with self.lock:
+            if status == "timeout":
+                self.timeouts += 1
+            else:
+                self.ack.record(seconds)
+
+    def record_error(self) -> None:
+        with self.lock:
+            self.errors += 1
+
+    def snapshot(self) -> Dict[str, object]:
+        with self.lock:
+            return {
+                "frames": self.frames,
+                "bytes_sent": self.bytes_sent,
+                "chunks": self.chunks,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "encode": self.encode.snapshot(),
+                "transmit": self.transmit.snapshot(),
+                "ack": self.ack.snapshot(),
+            }
@@ -0,0 +1,457 @@
+import json
+import re
+import struct
+from typing import List, Tuple
+
+# The tables and constants in this file are mirrored in 2040_scripts/rp2040i2c.py and
+# must be kept in sync with it.
+
+MESSAGE_CHUNK_SIZE = 32
+
+# every message is sent as a frame: a header carrying a magic byte, flags, a sequence
+# number and the payload length, followed by the payload. This lets the board stop
+# reading as soon as the whole frame has arrived instead of waiting out a fixed window.
+FRAME_MAGIC = 0xA5
+FRAME_HEADER = struct.Struct("<BBBH")
+# where the sequence number sits in a frame, so prepared frames can be renumbered
+FRAME_SEQUENCE_OFFSET = 2
+# the first byte of every write selects a register. Frames written as 32 byte smbus
+# blocks repeat the register byte in front of every block, raw frames written with
+# i2c_rdwr only have it in front of the first byte.
+FRAME_REGISTER = 0x00
+FRAME_REGISTER_RAW = 0x01
+
+# Writing this register byte on its own selects the status block for the next read. It
+# holds the sequence number of the last frame the board handled, an error code, a count
+# of frames handled and how long the last frame took to parse and apply in microseconds.
+STATUS_REGISTER = 0x10
+STATUS = struct.Struct("<BBHII")
+STATUS_NAMES = ("ok", "frame_error", "decode_error", "apply_error")
+# Selects the frame timing block: the board's target frame rate, frames shown and dropped
+# since boot, and the average and worst draw, show and start jitter times in microseconds
+# of the frames since the block was last read.
+TIMING_REGISTER = 0x11
+TIMING = struct.Struct("<HIIIIIII")
+# Selects the telemetry block: main loop passes per second and the average and worst
+# time animations took to draw in microseconds since the block was last read, free heap
+# bytes, how long the last command took to parse and apply in microseconds, commands
+# handled since boot, and payloads rejected as undecodable and frames that failed to
+# arrive or apply since boot. Reads are limited to 32 bytes.
+TELEMETRY_REGISTER = 0x12
+TELEMETRY = struct.Struct("<IIIIIIIHH")
+
+# low bits of the frame flags select how the payload is encoded
+ENCODING_JSON = 0x00
+ENCODING_BINARY = 0x01
+# JSON with common strings replaced by single byte tokens, see TOKENS
+ENCODING_TOKENS = 0x02
+
+# binary payloads start with a version byte followed by a list of records, each
+# beginning with one of these opcodes
+PROTOCOL_VERSION = 1
+OP_RECONFIGURE = 0x01
+OP_SET_ANIMATION = 0x02
+OP_PARAMS = 0x03
+OP_SET_PIXEL_COLORS = 0x04
+OP_PIXEL_RUNS = 0x05
+OP_PIXEL_COLOR_RUNS = 0x06
+# store_scene carries an id, flags and the length of the strand records that follow
+OP_STORE_SCENE = 0x07
+OP_PLAY_SCENE = 0x08
+# store_scene flag asking the board to also write the scene to its filesystem
+SCENE_PERSIST = 0x01
+# arm carries the length of the strand records that follow, fire has no arguments
+OP_ARM = 0x09
+OP_FIRE = 0x0A
+# changes the brightness of every strand without resetting them, unlike reconfigure
+OP_SET_BRIGHTNESS = 0x0B
+
+# Pixel runs start with the first pixel and the number of pixels. When this bit of the
+# number is set the run is followed by a single color to fill it with, otherwise by the
+# packed RGB bytes of every pixel in it.
+RUN_FILL = 0x8000
+# most runs per strand in one record
+MAX_RUNS = 255
+# runs of at least this many identical pixels are sent as fills
+MIN_FILL_LENGTH = 4
+
+ANIMATION_NAMES = (
+    "blink",
+    "colorcycle",
+    "comet",
+    "chase",
+    "pulse",
+    "sparkle",
+    "solid",
+    "rainbow",
+    "sparkle_pulse",
+    "rainbow_comet",
+    "rainbow_chase",
+    "rainbow_sparkle",
+    "custom_color_chase",
+)
+ANIMATION_IDS = {name: i for i, name in enumerate(ANIMATION_NAMES)}
+
+# value kinds for parameters
+KIND_FLOAT = "f"
+KIND_BYTE = "B"
+KIND_SHORT = "H"
+KIND_COLOR = "color"
+KIND_COLORS = "colors"
+
+# parameter id -> (name, kind)
+PARAMS = (
+    ("speed", KIND_FLOAT),
+    ("color", KIND_COLOR),
+    ("colors", KIND_COLORS),
+    ("tail_length", KIND_SHORT),
+    ("bounce", KIND_BYTE),
+    ("size", KIND_SHORT),
+    ("spacing", KIND_SHORT),
+    ("period", KIND_SHORT),
+    ("num_sparkles", KIND_SHORT),
+    ("step", KIND_SHORT),
+)
+PARAM_IDS = {name: (i, kind) for i, (name, kind) in enumerate(PARAMS)}
+
+# same values as adafruit_led_animation.color
+COLORS = {
+    "amber": (255, 100, 0),
+    "aqua": (50, 255, 255),
+    "black": (0, 0, 0),
+    "blue": (0, 0, 255),
+    "green": (0, 255, 0),
+    "orange": (255, 40, 0),
+    "pink": (242, 90, 255),
+    "purple": (180, 0, 255),
+    "red": (255, 0, 0),
+    "white": (255, 255, 255),
+    "yellow": (255, 150, 0),
+    "gold": (255, 222, 30),
+    "jade": (0, 255, 40),
+    "magenta": (255, 0, 20),
+    "old_lace": (253, 245, 230),
+    "teal": (0, 255, 120),
+}
+
+
+# Tokenized JSON payloads are compact JSON with each of these strings, quotes included,
+# replaced by the byte TOKEN_BASE + its index. The JSON is ASCII, so bytes from 0x80 up
+# can only be tokens. Only ever append to this table.
+TOKEN_BASE = 0x80
+TOKENS = (
+    (
+        "set_animation",
+        "set_pixel_colors",
+        "set_pixel_runs",
+        "sequence",
+        "animations",
+        "duration",
+        "reconfigure",
+        "num_strands",
+        "strand_length",
+        "brightness",
+        "store_scene",
+        "play_scene",
+        "id",
+        "command",
+        "persist",
+        "arm",
+        "fire",
+    )
+    + tuple(name for name, _ in PARAMS)
+    + ANIMATION_NAMES
+    + tuple(COLORS)
+    + ("set_brightness",)
+)
+_TOKEN_CHARS = {f'"{name}"': chr(TOKEN_BASE + i) for i, name in enumerate(TOKENS)}
+_JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+
+class UnencodableMessage(Exception):
+    """Raised when a message can't be expressed in the binary encoding and has to be
+    sent as JSON instead."""
+
+
+def divide_chunks(l, n):
+    """Divide a byte string into n byte chunks to send over i2c."""
+    for i in range(0, len(l), n):
+        yield l[i : i + n]
+
+
+def build_frame(payload: bytes, sequence: int, encoding: int) -> bytes:
+    return FRAME_HEADER.pack(FRAME_MAGIC, encoding, sequence, len(payload)) + payload
+
+
+def decode_status(data) -> dict:
+    sequence, error, frames, parse_us, apply_us = STATUS.unpack(bytes(data))
+    return {
+        "sequence": sequence,
+        "status": STATUS_NAMES[error] if error < len(STATUS_NAMES) else f"error_{error}",
+        "frames": frames,
+        "device_parse_ms": parse_us / 1000,
+        "device_apply_ms": apply_us / 1000,
+    }
+
+
+def decode_timing(data) -> dict:
+    fps, frames, dropped, draw_us, draw_max_us, show_us, jitter_us, jitter_max_us = (
+        TIMING.unpack(bytes(data))
+    )
+    return {
+        "target_fps": fps,
+        "frames": frames,
+        "frames_dropped": dropped,
+        "draw_ms": draw_us / 1000,
+        "draw_max_ms": draw_max_us / 1000,
+        "show_ms": show_us / 1000,
+        "jitter_ms": jitter_us / 1000,
+        "jitter_max_ms": jitter_max_us / 1000,
+    }
+
+
+def decode_telemetry(data) -> dict:
+    (
+        loop_rate,
+        animate_us,
+        animate_max_us,
+        mem_free,
+        parse_us,
+        apply_us,
+        commands,
+        rejected,
+        errors,
+    ) = TELEMETRY.unpack(bytes(data))
+    return {
+        "loop_rate": loop_rate,
+        "animate_ms": animate_us / 1000,
+        "animate_max_ms": animate_max_us / 1000,
+        "mem_free": mem_free,
+        "parse_ms": parse_us / 1000,
+        "apply_ms": apply_us / 1000,
+        "commands": commands,
+        "rejected": rejected,
+        "errors": errors,
+    }
+
+
+def encode_message(message, encoding: int):
+    """Encode a message with the requested encoding, falling back to tokenized JSON for
+    messages the binary encoding can't express.
+
+    Returns:
+        tuple of the encoding that was used and the payload bytes
+    """
+    if encoding == ENCODING_BINARY:
+        try:
+            return ENCODING_BINARY, encode_binary(message)
+        except (UnencodableMessage, KeyError, TypeError, ValueError):
+            pass
+    elif encoding == ENCODING_JSON:
+        return ENCODING_JSON, json.dumps(message).encode("utf-8")
+    return ENCODING_TOKENS, encode_tokens(message)
+
+
+def encode_tokens(message) -> bytes:
+    """Compact JSON with the strings in TOKENS replaced by their tokens."""
+    text = json.dumps(message, separators=(",", ":"))
+    return _JSON_STRING.sub(
+        lambda match: _TOKEN_CHARS.get(match.group(0), match.group(0)), text
+    ).encode("latin-1")
+
+
+def encode_binary(message) -> bytes:
+    out = bytearray((PROTOCOL_VERSION,))
+    for key, value in message.items():
+        if key == "reconfigure":
+            out += struct.pack(
+                "<BBHf",
+                OP_RECONFIGURE,
+                _ranged(value["num_strands"], 0xFF),
+                _ranged(value["strand_length"], 0xFFFF),
+                float(value["brightness"]),
+            )
+            continue
+        if key == "store_scene":
+            records = _encode_records(value["command"])
+            flags = SCENE_PERSIST if value.get("persist") else 0
+            out += struct.pack(
+                "<BBBH",
+                OP_STORE_SCENE,
+                _ranged(value["id"], 0xFF),
+                flags,
+                _ranged(len(records), 0xFFFF),
+            )
+            out += records
+            continue
+        if key == "play_scene":
+            out += struct.pack("<BB", OP_PLAY_SCENE, _ranged(value, 0xFF))
+            continue
+        if key == "arm":
+            records = _encode_records(value)
+            out += struct.pack("<BH", OP_ARM, _ranged(len(records), 0xFFFF))
+            out += records
+            continue
+        if key == "fire":
+            out.append(OP_FIRE)
+            continue
+        if key == "set_brightness":
+            out += struct.pack("<Bf", OP_SET_BRIGHTNESS, float(value))
+            continue
+        strand = _strand_index(key)
+        if not isinstance(value, dict):
+            raise UnencodableMessage(f"params for strand {key} are not a mapping")
+        _encode_strand(out, strand, value)
+    return bytes(out)
+
+
+def _encode_records(command) -> bytearray:
+    """Encode the strand records of a strand command nested in another record."""
+    records = bytearray()
+    for strand, params in command.items():
+        if not isinstance(params, dict):
+            raise UnencodableMessage(f"params for strand {strand} are not a mapping")
+        _encode_strand(records, _strand_index(strand), params)
+    return records
+
+
+def encode_pixel_runs(runs) -> bytes:
+    """Encode runs of packed RGB bytes, given as {strand: [(start pixel, rgb bytes)]}, which
+    the board copies straight into its pixel buffer."""
+    out = bytearray((PROTOCOL_VERSION,))
+    for strand, strand_runs in runs.items():
+        _encode_runs(out, OP_PIXEL_RUNS, strand, strand_runs)
+    return bytes(out)
+
+
+def pixel_runs(pixel_colors: dict) -> List[Tuple[int, bytes]]:
+    """Turn a set_pixel_colors mapping of pixel index to color into runs of consecutive
+    pixels, splitting off stretches of one color so they can be sent as fills."""
+    colors = sorted(
+        (_ranged(pixel, 0xFFFF), _encode_color(color))
+        for pixel, color in pixel_colors.items()
+    )
+    runs: List[Tuple[int, bytes]] = []
+    start = 0
+    for i in range(1, len(colors) + 1):
+        if i < len(colors) and colors[i][0] == colors[i - 1][0] + 1:
+            continue
+        runs.extend(_split_fills(colors[start:i]))
+        start = i
+    return runs
+
+
+def _split_fills(colors: List[Tuple[int, bytes]]) -> List[Tuple[int, bytes]]:
+    runs = []
+    packed = bytearray()
+    packed_start = colors[0][0] if colors else 0
+    i = 0
+    while i < len(colors):
+        j = i
+        while j < len(colors) and colors[j][1] == colors[i][1]:
+            j += 1
+        if j - i >= MIN_FILL_LENGTH:
+            if packed:
+                runs.append((packed_start, bytes(packed)))
+                packed = bytearray()
+            runs.append((colors[i][0], colors[i][1] * (j - i)))
+            packed_start = colors[j][0] if j < len(colors) else 0
+        else:
+            for _, color in colors[i:j]:
+                packed += color
+        i = j
+    if packed:
+        runs.append((packed_start, bytes(packed)))
+    return runs
+
+
+def _encode_runs(out: bytearray, op: int, strand: int, runs) -> None:
+    if len(runs) > MAX_RUNS:
+        raise UnencodableMessage(f"{len(runs)} pixel runs for strand {strand}")
+    out += struct.pack("<BBB", op, strand, len(runs))
+    for start, rgb in runs:
+        length = len(rgb) // 3
+        if length >= MIN_FILL_LENGTH and rgb == rgb[:3] * length:
+            out += struct.pack("<HH", start, _ranged(length, RUN_FILL - 1) | RUN_FILL)
+            out += rgb[:3]
+        else:
+            out += struct.pack("<HH", start, _ranged(length, RUN_FILL - 1))
+            out += rgb
+
+
+def _encode_strand(out: bytearray, strand: int, params: dict) -> None:
+    pixel_colors = params.get("set_pixel_colors")
+    if pixel_colors is not None:
+        if len(params) != 1 or not isinstance(pixel_colors, dict):
+            raise UnencodableMessage("set_pixel_colors can't be combined with params")
+        # pixels are usually set in stretches, which are smaller and faster to apply as
+        # runs, but scattered pixels take less space one by one
+        pixels = bytearray(
+            struct.pack(
+                "<BBH", OP_SET_PIXEL_COLORS, strand, _ranged(len(pixel_colors), 0xFFFF)
+            )
+        )
+        for pixel, color in pixel_colors.items():
+            pixels += struct.pack("<H", _ranged(pixel, 0xFFFF))
+            pixels += _encode_color(color)
+        runs = bytearray()
+        try:
+            _encode_runs(runs, OP_PIXEL_COLOR_RUNS, strand, pixel_runs(pixel_colors))
+        except UnencodableMessage:
+            runs = pixels
+        out += runs if len(runs) <= len(pixels) else pixels
+        return
+
+    animation = params.get("set_animation")
+    if animation is not None:
+        if animation not in ANIMATION_IDS:
+            raise UnencodableMessage(f"unknown animation {animation}")
+        out += struct.pack("<BBB", OP_SET_ANIMATION, strand, ANIMATION_IDS[animation])
+    else:
+        out += struct.pack("<BB", OP_PARAMS, strand)
+
+    names = [name for name in params if name != "set_animation"]
+    out.append(len(names))
+    for name in names:
+        if name not in PARAM_IDS:
+            raise UnencodableMessage(f"unknown param {name}")
+        param_id, kind = PARAM_IDS[name]
+        out.append(param_id)
+        value = params[name]
+        if kind == KIND_FLOAT:
+            out += struct.pack("<f", float(value))
+        elif kind == KIND_BYTE:
+            out.append(_ranged(value, 0xFF))
+        elif kind == KIND_SHORT:
+            out += struct.pack("<H", _ranged(value, 0xFFFF))
+        elif kind == KIND_COLOR:
+            out += _encode_color(value)
+        else:
+            out.append(_ranged(len(value), 0xFF))
+            for color in value:
+                out += _encode_color(color)
+
+
+def _encode_color(color) -> bytes:
+    if isinstance(color, str):
+        rgb = COLORS.get(color.lower())
+        if rgb is None:
+            raise UnencodableMessage(f"unknown color {color}")
+        return bytes(rgb)
+    if len(color) < 3:
+        raise UnencodableMessage(f"invalid color {color}")
+    return bytes(_ranged(c, 0xFF) for c in color[:3])
+
+
+def _strand_index(key) -> int:
+    return _ranged(key, 0xFF)
+
+
+def _ranged(value, maximum: int) -> int:
+    try:
+        number = int(float(value))
+    except (TypeError, ValueError):
+        raise UnencodableMessage(f"invalid integer value {value}")
+    if number < 0 or number > maximum:
+        raise UnencodableMessage(f"value {value} out of range")
+    return number
@@ -0,0 +1,266 @@
+from typing import Dict, List
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from protocol import ANIMATION_NAMES, COLORS
+
+# same defaults as PixelStrand in the firmware
+DEFAULT_PARAMS = {
+    "speed": 0.1,
+    "colors": [COLORS["red"]],
+    "tail_length": 10,
+    "bounce": False,
+    "size": 1,
+    "spacing": 1,
+    "period": 1,
+    "num_sparkles": 1,
+    "step": 1,
+}
+# brightness of the unlit background of sparkle animations
+SPARKLE_BACKGROUND = 0.1
+# speed is a step interval in seconds, keep it from dividing by zero
+MIN_SPEED = 0.001
+
+
+def parse_colors(colors) -> List[tuple]:
+    parsed = []
+    for color in colors:
+        if isinstance(color, str):
+            if color.lower() not in COLORS:
+                raise ValueError(f"invalid color name {color}")
+            parsed.append(COLORS[color.lower()])
+        else:
+            parsed.append((int(color[0]), int(color[1]), int(color[2])))
+    if not parsed:
+        raise ValueError("at least one color is required")
+    return parsed
+
+
+class StrandState:
+    """The animation a strand runs on the host and its params, mirroring what
+    PixelStrand keeps on the board."""
+
+    def __init__(self, started: float) -> None:
+        self.animation_name = "rainbow_comet"
+        self.params = dict(DEFAULT_PARAMS)
+        self.started = started
+
+    def update(self, params: dict, now: float) -> None:
+        """Apply a strand command the same way PixelStrand.handle_command does. Setting
+        an animation restarts its timing."""
+        params = {key: value for key, value in params.items() if key != "render"}
+        animation_name = params.pop("set_animation", None)
+        if animation_name is not None and animation_name not in ANIMATION_NAMES:
+            raise ValueError("invalid animation name")
+        updated = dict(self.params)
+        for name, value in params.items():
+            if name == "color":
+                updated["colors"] = parse_colors([value])
+            elif name == "colors":
+                updated["colors"] = parse_colors(value)
+            elif name == "speed":
+                updated["speed"] = float(value)
+            elif name in DEFAULT_PARAMS:
+                updated[name] = int(value)
+            else:
+                raise ValueError(f"invalid arg: {name}")
+        self.params = updated
+        if animation_name is not None:
+            self.animation_name = animation_name
+            self.started = now
+
+
+class _Batch:
+    """Parameters of every strand running one animation, as arrays shaped to broadcast
+    against the (strands, pixels, rgb) output."""
+
+    def __init__(self, states: List[StrandState], strand_length: int, now: float) -> None:
+        def column(name, dtype=float):
+            return np.array([s.params[name] for s in states], dtype=dtype)[:, None]
+
+        self.length = strand_length
+        self.pixel = np.arange(strand_length)[None, :]
+        self.t = np.array([now - s.started for s in states])[:, None]
+        self.speed = np.maximum(column("speed"), MIN_SPEED)
+        self.steps = (self.t // self.speed).astype(np.int64)
+        self.tail_length = np.maximum(column("tail_length", np.int64), 1)
+        self.bounce = column("bounce", bool)
+        self.size = np.maximum(column("size", np.int64), 1)
+        self.spacing = np.maximum(column("spacing", np.int64), 0)
+        self.period = np.maximum(column("period"), MIN_SPEED)
+        self.num_sparkles = column("num_sparkles")
+        self.step = column("step", np.int64)
+        max_colors = max(len(s.params["colors"]) for s in states)
+        self.colors = np.zeros((len(states), max_colors, 3))
+        for i, s in enumerate(states):
+            self.colors[i, : len(s.params["colors"])] = s.params["colors"]
+        self.num_colors = np.array([len(s.params["colors"]) for s in states])[:, None]
+        self.color = self.colors[:, 0][:, None, :]
+
+    def pick_colors(self, index) -> "np.ndarray":
+        """Look up colors[index % number of colors] per strand and pixel."""
+        rows = np.arange(self.colors.shape[0])[:, None]
+        return self.colors[rows, index % self.num_colors]
+
+    def pulse(self) -> "np.ndarray":
+        return (0.5 - 0.5 * np.cos(2 * np.pi * self.t / self.period))[:, :, None]
+
+    def sparkles(self) -> "np.ndarray":
+        # a hash of pixel and step, so sparkles stay put until the next step
+        noise = np.sin(self.pixel * 12.9898 + self.steps * 78.233) * 43758.5453
+        noise -= np.floor(noise)
+        return (noise < self.num_sparkles / self.length)[:, :, None]
+
+    def comet(self) -> "np.ndarray":
+        """Distance of each pixel behind the comet head, -1 where the comet isn't."""
+        span = self.length + self.tail_length
+        position = self.steps % np.where(self.bounce, 2 * span, span)
+        backwards = position >= span
+        head = np.where(backwards, position - span, position)
+        pixel = np.where(backwards, self.length - 1 - self.pixel, self.pixel)
+        distance = head - pixel
+        return np.where((distance >= 0) & (distance < self.tail_length), distance, -1)
+
+    def chase(self):
+        """Whether each pixel is on a chase bar and the index of that bar."""
+        offset = self.pixel - self.steps
+        width = self.size + self.spacing
+        return (offset % width < self.size)[:, :, None], offset // width
+
+
+def wheel(position) -> "np.ndarray":
+    """Vectorized rainbowio.colorwheel for positions 0-255."""
+    position = np.asarray(position) % 256
+    third = position % 85 * 3
+    rising = np.stack([255 - third, third, np.zeros_like(third)], axis=-1)
+    return np.where(
+        (position < 85)[..., None],
+        rising,
+        np.where(
+            (position < 170)[..., None],
+            np.roll(rising, 1, axis=-1),
+            np.roll(rising, 2, axis=-1),
+        ),
+    )
+
+
+def _blink(b: _Batch):
+    return b.color * (b.steps % 2 == 0)[:, :, None]
+
+
+def _colorcycle(b: _Batch):
+    return np.broadcast_to(b.pick_colors(b.steps), (b.t.shape[0], b.length, 3))
+
+
+def _comet(b: _Batch):
+    distance = b.comet()
+    level = np.where(distance >= 0, 1 - distance / b.tail_length, 0)
+    return b.color * level[:, :, None]
+
+
+def _chase(b: _Batch):
+    on, _ = b.chase()
+    return b.color * on
+
+
+def _pulse(b: _Batch):
+    return b.color * b.pulse()
+
+
+def _sparkle(b: _Batch):
+    return b.color * np.where(b.sparkles(), 1.0, SPARKLE_BACKGROUND)
+
+
+def _solid(b: _Batch):
+    return b.color * np.ones((1, b.length, 1))
+
+
+def _rainbow(b: _Batch):
+    return wheel((b.pixel / b.length + b.t / b.period) * 256)
+
+
+def _sparkle_pulse(b: _Batch):
+    return b.color * b.sparkles() * b.pulse()
+
+
+def _rainbow_comet(b: _Batch):
+    distance = b.comet()
+    level = np.where(distance >= 0, 1 - distance / b.tail_length, 0)
+    return wheel(distance * 256 // b.tail_length) * level[:, :, None]
+
+
+def _rainbow_chase(b: _Batch):
+    on, bar = b.chase()
+    return wheel((bar + b.steps // (b.size + b.spacing)) * b.step) * on
+
+
+def _rainbow_sparkle(b: _Batch):
+    colors = wheel((b.pixel / b.length + b.t / b.period) * 256)
+    return colors * np.where(b.sparkles(), 1.0, SPARKLE_BACKGROUND)
+
+
+def _custom_color_chase(b: _Batch):
+    on, bar = b.chase()
+    return b.pick_colors(bar) * on
+
+
+KERNELS = {
+    "blink": _blink,
+    "colorcycle": _colorcycle,
+    "comet": _comet,
+    "chase": _chase,
+    "pulse": _pulse,
+    "sparkle": _sparkle,
+    "solid": _solid,
+    "rainbow": _rainbow,
+    "sparkle_pulse": _sparkle_pulse,
+    "rainbow_comet": _rainbow_comet,
+    "rainbow_chase": _rainbow_chase,
+    "rainbow_sparkle": _rainbow_sparkle,
+    "custom_color_chase": _custom_color_chase,
+}
+
+
+class HostRenderer:
+    """Renders the firmware's animation catalog on the host as NumPy kernels over the
+    whole (strands, pixels, rgb) frame, for strands that are switched to host rendering.
+    Strands running the same animation are rendered together in one kernel call."""
+
+    def __init__(self, num_strands: int, strand_length: int) -> None:
+        if np is None:
+            raise ImportError("host rendering requires numpy")
+        self.num_strands = num_strands
+        self.strand_length = strand_length
+        self.strands: Dict[int, StrandState] = {}
+        self.frame = np.zeros((num_strands, strand_length, 3), dtype=np.uint8)
+
+    def update(self, strand: int, params: dict, now: float) -> None:
+        """Apply a strand command, switching the strand to host rendering."""
+        if not 0 <= strand < self.num_strands:
+            raise ValueError("index out of bound for configured number of leds")
+        state = self.strands.get(strand) or StrandState(now)
+        state.update(params, now)
+        self.strands[strand] = state
+
+    def release(self, strand: int) -> None:
+        """Hand a strand back to the board."""
+        self.strands.pop(strand, None)
+        self.frame[strand] = 0
+
+    def render(self, now: float) -> "np.ndarray":
+        """Render the host strands into the frame, leaving the other strands black.
+
+        Returns:
+            np.ndarray: the (num_strands, strand_length, 3) uint8 frame
+        """
+        by_animation: Dict[str, List[int]] = {}
+        for strand, state in self.strands.items():
+            by_animation.setdefault(state.animation_name, []).append(strand)
+        for name, strands in by_animation.items():
+            batch = _Batch([self.strands[s] for s in strands], self.strand_length, now)
+            pixels = KERNELS[name](batch)
+            self.frame[strands] = np.clip(pixels, 0, 255).astype(np.uint8)
+        return self.frame
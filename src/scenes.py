@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict
+
+DEFAULT_SCENE_CACHE_SIZE = 16
+
+
+class SceneLibrary:
+    """Named strand commands from the config, compiled into ready to send frames on
+    first use. Compiled scenes are kept in an LRU cache of cache_size entries, so
+    switching to a recently played scene is a dictionary lookup."""
+
+    def __init__(
+        self,
+        scenes: Dict[str, dict],
+        compile: Callable[[dict], object],
+        cache_size: int = DEFAULT_SCENE_CACHE_SIZE,
+    ) -> None:
+        self.scenes = scenes
+        self.compile = compile
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.cache: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # warm the cache with the first scenes of the library
+        for name in list(scenes)[:cache_size]:
+            self.cache[name] = compile(scenes[name])
+
+    def __contains__(self, name) -> bool:
+        return name in self.scenes
+
+    def get(self, name: str):
+        with self.lock:
+            compiled = self.cache.get(name)
+            if compiled is not None:
+                self.cache.move_to_end(name)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        compiled = self.compile(self.scenes[name])
+        with self.lock:
+            self.cache[name] = compiled
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return compiled
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "scenes": len(self.scenes),
+            "cached": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+from protocol import MAX_RUNS, encode_pixel_runs
+
+# unchanged pixels between two changed ones are sent anyway when the gap is at most this
+# long, since starting a new run costs 4 bytes
+MAX_RUN_GAP = 2
+# number of sent frames the fps counter averages over
+FPS_WINDOW = 60
+
+
+def frame_bytes(frame) -> bytes:
+    """Accept bytes, bytearrays or C-contiguous uint8 NumPy arrays of any shape."""
+    return bytes(memoryview(frame).cast("B"))
+
+
+def changed_runs(old: Optional[bytes], new: bytes) -> List[Tuple[int, int]]:
+    """Find the (start, end) pixel ranges of a strand that differ between two frames.
+
+    Args:
+        old: the RGB bytes the board has for the strand, or None if they are unknown
+        new: the RGB bytes to send for the strand
+    """
+    strand_length = len(new) // 3
+    if old is None:
+        return [(0, strand_length)]
+    if old == new:
+        return []
+
+    runs = []
+    start = -1
+    last = -1
+    for pixel in range(strand_length):
+        i = pixel * 3
+        if old[i : i + 3] != new[i : i + 3]:
+            if start < 0:
+                start = pixel
+            last = pixel
+        elif start >= 0 and pixel - last > MAX_RUN_GAP:
+            runs.append((start, last + 1))
+            start = -1
+    if start >= 0:
+        runs.append((start, last + 1))
+    if len(runs) > MAX_RUNS:
+        return [(runs[0][0], runs[-1][1])]
+    return runs
+
+
+class FrameStreamer:
+    """Streams whole frames (num_strands x strand_length x 3 RGB bytes) to the board,
+    sending only the pixel runs that changed since the last frame that was written
+    successfully.
+
+    Only the newest submitted frame is sent: frames that arrive while an older one is
+    still waiting for the bus replace it and are counted as dropped. schedule is called
+    with a job that takes a function writing a binary payload to the bus and returning
+    the board's status, or None if acknowledgements are disabled.
+    """
+
+    def __init__(
+        self,
+        num_strands: int,
+        strand_length: int,
+        schedule: Callable[[Callable[[Callable[[bytes], Optional[dict]]], None]], Future],
+    ) -> None:
+        self.num_strands = num_strands
+        self.strand_length = strand_length
+        self.schedule = schedule
+        self.lock = threading.Lock()
+        self.latest: Optional[bytes] = None
+        self.latest_strands: Optional[List[int]] = None
+        self.future: Optional[Future] = None
+        # what the board last received per strand, None when it is unknown
+        self.acknowledged: List[Optional[bytes]] = [None] * num_strands
+        # bumped by invalidate so a send in flight doesn't overwrite the invalidation
+        self.generations = [0] * num_strands
+        self.sent_times: deque = deque(maxlen=FPS_WINDOW)
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+
+    @property
+    def frame_size(self) -> int:
+        return self.num_strands * self.strand_length * 3
+
+    def submit(self, frame, strands=None) -> Future:
+        """Queue a frame, replacing any frame that has not been sent yet.
+
+        Args:
+            frame: the RGB bytes of every strand
+            strands: the strands of the frame to send, all by default. The board keeps
+                showing whatever it has on the others.
+
+        Returns:
+            Future: resolves once the frame, or a newer one replacing it, has been sent
+        """
+        data = frame_bytes(frame)
+        if len(data) != self.frame_size:
+            raise ValueError(
+                f"frame has {len(data)} bytes, expected {self.frame_size} "
+                f"({self.num_strands} strands x {self.strand_length} pixels x 3)"
+            )
+        with self.lock:
+            if self.future is None:
+                self.future = self.schedule(self._send)
+            else:
+                self.frames_dropped += 1
+            self.latest = data
+            self.latest_strands = None if strands is None else list(strands)
+            return self.future
+
+    def invalidate(self, strands=None) -> None:
+        """Forget what the board shows on the given strands (all by default), for example
+        after an animation was started on them, so the next frame resends them in full."""
+        with self.lock:
+            for strand in range(self.num_strands) if strands is None else strands:
+                if 0 <= strand < self.num_strands:
+                    self.acknowledged[strand] = None
+                    self.generations[strand] += 1
+
+    def fps(self) -> float:
+        with self.lock:
+            if len(self.sent_times) < 2:
+                return 0.0
+            elapsed = self.sent_times[-1] - self.sent_times[0]
+            return (len(self.sent_times) - 1) / elapsed if elapsed > 0 else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "fps": self.fps(),
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+            "bytes_sent": self.bytes_sent,
+        }
+
+    def _send(self, write: Callable[[bytes], Optional[dict]]) -> Optional[dict]:
+        # runs on the i2c worker thread
+        with self.lock:
+            frame = self.latest
+            self.latest = None
+            selected = self.latest_strands
+            if selected is None:
+                selected = range(self.num_strands)
+            self.future = None
+            acknowledged = list(self.acknowledged)
+            generations = list(self.generations)
+
+        strand_bytes = self.strand_length * 3
+        strands = {
+            i: frame[i * strand_bytes : (i + 1) * strand_bytes] for i in selected
+        }
+        runs: Dict[int, List[Tuple[int, bytes]]] = {}
+        for strand, new in strands.items():
+            strand_runs = changed_runs(acknowledged[strand], new)
+            if strand_runs:
+                runs[strand] = [
+                    (start, new[start * 3 : end * 3]) for start, end in strand_runs
+                ]
+
+        status = None
+        if runs:
+            payload = encode_pixel_runs(runs)
+            try:
+                status = write(payload)
+            except Exception:
+                self.invalidate(runs)
+                raise
+            self.bytes_sent += len(payload)
+        # without an ack from the board, what it shows is unknown and the next frame is
+        # sent in full
+        applied = status is None or status["status"] == "ok"
+
+        with self.lock:
+            for strand, new in strands.items():
+                if self.generations[strand] == generations[strand]:
+                    self.acknowledged[strand] = new if applied else None
+            self.frames_sent += 1
+            self.sent_times.append(time.monotonic())
+        return status
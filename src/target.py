@@ -0,0 +1,325 @@
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+from smbus2 import SMBus
+from viam import logging
+
+from coalesce import CommandCoalescer
+from metrics import TransportStats
+from protocol import ENCODING_BINARY, FRAME_SEQUENCE_OFFSET, build_frame, encode_message
+from stream import FrameStreamer
+from transport import (
+    I2CWorker,
+    TransportBusy,
+    count_chunks,
+    read_telemetry,
+    read_timing,
+    wait_for_status,
+    write_frame,
+    write_frames,
+)
+
+LOG = logging.getLogger(__name__)
+
+# weight of the newest sample in the running average of the send latency
+LATENCY_SMOOTHING = 0.2
+# the board's frame counter in its status block wraps around at this
+FRAME_COUNTER_RANGE = 65536
+
+
+class LedTarget:
+    """One board at one address on one i2c bus. Owns the sequence numbers, pending strand
+    commands and streamed frame state for that board; the bus itself belongs to a worker
+    that may be shared with other targets.
+
+    Strand indexes passed to a target are local to the board, first_strand is where its
+    strands start in the component's combined strand index space.
+    """
+
+    def __init__(
+        self,
+        worker: I2CWorker,
+        address: int,
+        first_strand: int,
+        num_strands: int,
+        strand_length: int,
+        encoding: int,
+        transfer_mode: str,
+        transfer_size: int,
+        ack_timeout: float,
+    ) -> None:
+        self.worker = worker
+        self.address = address
+        self.first_strand = first_strand
+        self.num_strands = num_strands
+        self.strand_length = strand_length
+        self.encoding = encoding
+        self.transfer_mode = transfer_mode
+        self.transfer_size = transfer_size
+        self.ack_timeout = ack_timeout
+        self.sequence = 0
+        # (num_strands, strand_length, brightness) last sent or queued to the board, None
+        # while it may not hold it: the message failed, or a status showed the board
+        # restarted
+        self.configured: Optional[Tuple[int, int, float]] = None
+        # the board's frame counter in the last status and the frames written since, to
+        # tell when the board restarted
+        self.device_frames: Optional[int] = None
+        self.frames_written = 0
+        # running average of the seconds from queueing a prepared frame to it being written
+        self.latency = 0.0
+        self.stats = TransportStats()
+        self.coalescer = CommandCoalescer(self.schedule_message)
+        self.streamer = FrameStreamer(num_strands, strand_length, self.schedule_stream)
+
+    @property
+    def name(self) -> str:
+        return f"{self.worker.bus_number}:0x{self.address:02x}"
+
+    def add_command(self, command) -> Future:
+        """Merge a strand command into the board's pending batch."""
+        self.streamer.invalidate(int(key) for key in command)
+        return self.coalescer.add(command)
+
+    def stream_frame(self, frame, strands=None) -> Future:
+        return self.streamer.submit(frame, strands)
+
+    def config_message(self, brightness: float) -> Optional[dict]:
+        """The message bringing the board from the configuration it was last sent to the
+        new one: nothing if it is unchanged, set_brightness if only the brightness
+        changed, which the board applies without resetting its strands, otherwise
+        reconfigure."""
+        if self.configured == (self.num_strands, self.strand_length, brightness):
+            return None
+        if self.configured is not None and self.configured[:2] == (
+            self.num_strands,
+            self.strand_length,
+        ):
+            return {"set_brightness": brightness}
+        return {
+            "reconfigure": {
+                "num_strands": self.num_strands,
+                "strand_length": self.strand_length,
+                "brightness": brightness,
+            }
+        }
+
+    def configure(self, message, brightness: float) -> Future:
+        """Queue a message from config_message. Later ones are diffed against it right
+        away, unless it fails, which gets the board a full reconfigure next time."""
+        self.configured = (self.num_strands, self.strand_length, brightness)
+        future = self.send_message(message)
+        future.add_done_callback(self._configure_done)
+        return future
+
+    def _configure_done(self, future: Future) -> None:
+        if future.exception() is not None:
+            self.configured = None
+            return
+        status = future.result()
+        if status is not None and status["status"] != "ok":
+            self.configured = None
+
+    def check_status(self, status: dict) -> None:
+        """Notice from the status of a frame that the board restarted and lost its
+        configuration: it counted fewer frames than were written to it since the last
+        status. A restarted board is reconfigured right away."""
+        if status["status"] == "timeout":
+            # the frames may or may not have reached the board
+            self.device_frames = None
+            self.frames_written = 0
+            return
+        expected = None
+        if self.device_frames is not None:
+            expected = (self.device_frames + self.frames_written) % FRAME_COUNTER_RANGE
+        self.device_frames = status["frames"]
+        self.frames_written = 0
+        behind = (
+            expected is not None
+            and 0 < (expected - status["frames"]) % FRAME_COUNTER_RANGE
+            < FRAME_COUNTER_RANGE // 2
+        )
+        if not behind:
+            return
+        configured = self.configured
+        self.configured = None
+        if configured is not None:
+            LOG.warning(f"board {self.name} restarted, reconfiguring it")
+            brightness = configured[2]
+            try:
+                self.configure(self.config_message(brightness), brightness)
+            except TransportBusy:
+                LOG.error(f"board {self.name} restarted, but its bus queue is full")
+
+    def send_message(self, message) -> Future:
+        """Queue a message on the i2c worker thread, after any pending strand commands.
+
+        Returns:
+            Future: resolves to the board's status once the message has been written to
+                the bus, or None if acknowledgements are disabled
+        """
+        self.begin_message()
+        return self.schedule_message(lambda: message)
+
+    def begin_message(self, strands=None) -> None:
+        """Get ready to queue a message that isn't a strand command: pending strand
+        commands are sent before it, and the streamer forgets the strands it may change
+        (all by default)."""
+        self.coalescer.seal()
+        self.streamer.invalidate(strands)
+
+    def prepare_message(self, message) -> bytearray:
+        """Encode a message into a frame ahead of time, for send_prepared."""
+        started = time.perf_counter()
+        encoding, payload = encode_message(message, self.encoding)
+        self.stats.record_encode(time.perf_counter() - started)
+        return bytearray(build_frame(payload, 0, encoding))
+
+    def send_prepared(
+        self,
+        frame: bytearray,
+        strands,
+        written: Optional[Callable[[float], None]] = None,
+    ) -> Future:
+        """Queue a frame from prepare_message, like send_message does with a message.
+
+        Args:
+            strands: the strands the frame changes
+            written: called on the worker thread with the time.perf_counter() at which
+                the frame was written, before waiting for the board's status
+        """
+        self.begin_message(strands)
+        queued = time.perf_counter()
+        return self.worker.submit(
+            lambda bus: self.write_prepared(bus, frame, queued, written)
+        )
+
+    def read_timing(self) -> Future:
+        """Queue a read of the board's frame timing block."""
+        return self.worker.submit(lambda bus: read_timing(bus, self.address))
+
+    def read_telemetry(self) -> Future:
+        """Queue a read of the board's telemetry block."""
+        return self.worker.submit(lambda bus: read_telemetry(bus, self.address))
+
+    def schedule_message(self, get_message) -> Future:
+        """Queue a job that fetches a message, encodes it and writes it to the bus. The
+        message is only fetched once the worker gets to it, so it can still change while
+        it waits in the queue."""
+        return self.worker.submit(lambda bus: self.write_message(bus, get_message()))
+
+    def schedule_stream(self, send) -> Future:
+        return self.worker.submit(
+            lambda bus: send(
+                lambda payload: self.write_payload(bus, ENCODING_BINARY, payload)
+            )
+        )
+
+    def write_message(self, bus: SMBus, message) -> Optional[dict]:
+        started = time.perf_counter()
+        encoding, payload = encode_message(message, self.encoding)
+        self.stats.record_encode(time.perf_counter() - started)
+        return self.write_payload(bus, encoding, payload)
+
+    def write_payload(self, bus: SMBus, encoding: int, payload: bytes) -> Optional[dict]:
+        """Write a frame and, unless acknowledgements are disabled, wait for the board to
+        report that it handled it.
+
+        Returns:
+            dict: the board's status for the frame and the round trip time, or None if
+                acknowledgements are disabled
+        """
+        # runs on the worker thread, which also keeps sequence numbers in wire order
+        self.sequence = (self.sequence + 1) % 256
+        return self.write_numbered(bus, build_frame(payload, self.sequence, encoding))
+
+    def write_prepared(
+        self,
+        bus: SMBus,
+        frame: bytearray,
+        queued: float,
+        written: Optional[Callable[[float], None]],
+    ) -> Optional[dict]:
+        # prepared frames are only written from this target's worker thread
+        self.sequence = (self.sequence + 1) % 256
+        frame[FRAME_SEQUENCE_OFFSET] = self.sequence
+
+        def done(now: float) -> None:
+            self.latency += LATENCY_SMOOTHING * (now - queued - self.latency)
+            if written is not None:
+                written(now)
+
+        return self.write_numbered(bus, frame, done)
+
+    def write_numbered(
+        self, bus: SMBus, frame, written: Optional[Callable[[float], None]] = None
+    ) -> Optional[dict]:
+        started = time.perf_counter()
+        try:
+            write_frame(bus, self.address, frame, self.transfer_mode, self.transfer_size)
+        except OSError:
+            self.stats.record_error()
+            raise
+        now = time.perf_counter()
+        self.frames_written += 1
+        self.stats.record_write(
+            len(frame),
+            count_chunks(len(frame), self.transfer_mode, self.transfer_size),
+            now - started,
+        )
+        if written is not None:
+            written(now)
+        if self.ack_timeout <= 0:
+            return None
+        status = wait_for_status(bus, self.address, self.sequence, self.ack_timeout)
+        self.stats.record_ack(status["status"], time.perf_counter() - now)
+        self.check_status(status)
+        status["round_trip_ms"] = (time.perf_counter() - started) * 1000
+        return status
+
+
+def write_together(bus: SMBus, targets: List[LedTarget], message) -> List[dict]:
+    """Write the same message to several boards on one bus as close together as the
+    bus allows, and only then wait for their statuses. Must run on the bus's worker.
+
+    Returns:
+        list of statuses in target order, each with written_at, the time.perf_counter()
+            at which the write to that board finished
+    """
+    frames = []
+    for target in targets:
+        encoded = time.perf_counter()
+        encoding, payload = encode_message(message, target.encoding)
+        target.stats.record_encode(time.perf_counter() - encoded)
+        target.sequence = (target.sequence + 1) % 256
+        frames.append((target.address, build_frame(payload, target.sequence, encoding)))
+    transfer_mode = targets[0].transfer_mode
+    started = time.perf_counter()
+    try:
+        written = write_frames(bus, frames, transfer_mode)
+    except OSError:
+        for target in targets:
+            target.stats.record_error()
+        raise
+
+    statuses = []
+    previous = started
+    for target, (_, frame), written_at in zip(targets, frames, written):
+        # write_frames doesn't split frames into transfer_size messages
+        target.stats.record_write(
+            len(frame), count_chunks(len(frame), transfer_mode), written_at - previous
+        )
+        previous = written_at
+        target.frames_written += 1
+        status = {"sequence": target.sequence}
+        if target.ack_timeout > 0:
+            status = wait_for_status(
+                bus, target.address, target.sequence, target.ack_timeout
+            )
+            target.stats.record_ack(status["status"], time.perf_counter() - written_at)
+            target.check_status(status)
+            status["round_trip_ms"] = (time.perf_counter() - started) * 1000
+        status["written_at"] = written_at
+        statuses.append(status)
+    return statuses
@@ -0,0 +1,271 @@
+import queue
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from smbus2 import SMBus, i2c_msg
+
+from protocol import (
+    FRAME_REGISTER,
+    FRAME_REGISTER_RAW,
+    MESSAGE_CHUNK_SIZE,
+    STATUS,
+    STATUS_REGISTER,
+    TELEMETRY,
+    TELEMETRY_REGISTER,
+    TIMING,
+    TIMING_REGISTER,
+    decode_status,
+    decode_telemetry,
+    decode_timing,
+    divide_chunks,
+)
+
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_ACK_TIMEOUT = 0.25
+# pause between status polls while waiting for the board to handle a frame
+ACK_POLL_INTERVAL = 0.0005
+
+# block writes send one smbus transaction per 32 bytes, rdwr writes send the whole frame
+# in a single i2c_rdwr call, optionally split into transfer_size byte messages
+TRANSFER_BLOCK = "block"
+TRANSFER_RDWR = "rdwr"
+TRANSFER_MODES = (TRANSFER_BLOCK, TRANSFER_RDWR)
+# linux refuses i2c_rdwr calls with more messages than this
+MAX_RDWR_MESSAGES = 42
+
+
+class TransportBusy(Exception):
+    """Raised when the command queue of an i2c worker is full."""
+
+
+class I2CWorker:
+    """Owns an SMBus handle and runs every transfer on a dedicated thread, so callers on
+    the asyncio event loop never block on the bus. Jobs are callables taking the bus
+    and are run in submission order."""
+
+    def __init__(self, bus_number: int, queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+        self.bus_number = bus_number
+        self.jobs: queue.Queue = queue.Queue(maxsize=queue_size)
+        # deepest the queue has been since the last reset_stats
+        self.max_depth = 0
+        self.thread = threading.Thread(
+            target=self._run, name=f"i2c-{bus_number}", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, job: Callable[[SMBus], object]) -> Future:
+        """Queue a job for the worker thread.
+
+        Returns:
+            Future: resolves to the return value of the job
+
+        Raises:
+            TransportBusy: the queue is full
+        """
+        future: Future = Future()
+        try:
+            self.jobs.put_nowait((job, future))
+        except queue.Full:
+            raise TransportBusy(
+                f"i2c bus {self.bus_number} has {self.jobs.maxsize} commands queued"
+            )
+        depth = self.jobs.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return future
+
+    def stats(self) -> Dict[str, int]:
+        return {"queue_depth": self.jobs.qsize(), "queue_max": self.max_depth}
+
+    def reset_stats(self) -> None:
+        self.max_depth = self.jobs.qsize()
+
+    def close(self) -> None:
+        # the sentinel waits behind any queued jobs, so they are still sent
+        self.jobs.put((None, None))
+        self.thread.join()
+
+    def _run(self) -> None:
+        with SMBus(self.bus_number) as bus:
+            while True:
+                job, future = self.jobs.get()
+                if job is None:
+                    return
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(job(bus))
+                except Exception as e:
+                    future.set_exception(e)
+
+
+class BusRegistry:
+    """Shares one reference counted I2CWorker per bus number between every target on that
+    bus, including targets of other components in the same module process. The worker's
+    queue serializes transfers on a bus, while separate buses run in parallel."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.workers: Dict[int, I2CWorker] = {}
+        self.refs: Dict[int, int] = {}
+
+    def acquire(self, bus_number: int, queue_size: int = DEFAULT_QUEUE_SIZE) -> I2CWorker:
+        """Get the worker for a bus, starting it if this is its first user. The queue size
+        of the first user applies."""
+        with self.lock:
+            if bus_number not in self.workers:
+                self.workers[bus_number] = I2CWorker(bus_number, queue_size)
+                self.refs[bus_number] = 0
+            self.refs[bus_number] += 1
+            return self.workers[bus_number]
+
+    def release(self, worker: I2CWorker) -> None:
+        """Drop a reference to a worker, closing it once nothing uses its bus anymore."""
+        with self.lock:
+            self.refs[worker.bus_number] -= 1
+            if self.refs[worker.bus_number] > 0:
+                return
+            del self.refs[worker.bus_number]
+            del self.workers[worker.bus_number]
+        worker.close()
+
+
+BUSES = BusRegistry()
+
+
+def gather_futures(futures: Sequence[Future]) -> Future:
+    """Combine futures into one that resolves to the list of their results, or to the
+    first exception once all of them are done."""
+    combined: Future = Future()
+    results: List[object] = [None] * len(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(index: int, future: Future) -> None:
+        if not future.cancelled() and future.exception() is None:
+            results[index] = future.result()
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        for f in futures:
+            if f.cancelled() or f.exception() is not None:
+                combined.set_exception(
+                    CancelledError() if f.cancelled() else f.exception()
+                )
+                return
+        combined.set_result(results)
+
+    if not futures:
+        combined.set_result(results)
+    for index, future in enumerate(futures):
+        future.add_done_callback(lambda f, index=index: done(index, f))
+    return combined
+
+
+def write_frame(
+    bus: SMBus,
+    address: int,
+    frame: bytes,
+    transfer_mode: str = TRANSFER_BLOCK,
+    transfer_size: int = 0,
+) -> None:
+    """Write a frame to the board.
+
+    Args:
+        transfer_mode: TRANSFER_BLOCK or TRANSFER_RDWR
+        transfer_size: for TRANSFER_RDWR, the largest message to send, or 0 to send the
+            whole frame as one message
+    """
+    if transfer_mode == TRANSFER_RDWR:
+        data = bytes((FRAME_REGISTER_RAW,)) + frame
+        segments = list(divide_chunks(data, transfer_size or len(data)))
+        for i in range(0, len(segments), MAX_RDWR_MESSAGES):
+            bus.i2c_rdwr(
+                *(
+                    i2c_msg.write(address, segment)
+                    for segment in segments[i : i + MAX_RDWR_MESSAGES]
+                )
+            )
+        return
+    for chunk in divide_chunks(frame, MESSAGE_CHUNK_SIZE):
+        bus.write_i2c_block_data(address, FRAME_REGISTER, chunk)
+
+
+def count_chunks(size: int, transfer_mode: str, transfer_size: int = 0) -> int:
+    """Number of block writes or i2c_rdwr messages write_frame splits a frame into."""
+    if transfer_mode == TRANSFER_RDWR:
+        # the register byte goes in front of the frame
+        size += 1
+        chunk_size = transfer_size or size
+    else:
+        chunk_size = MESSAGE_CHUNK_SIZE
+    return -(-size // chunk_size)
+
+
+def write_frames(
+    bus: SMBus,
+    frames: Sequence[Tuple[int, bytes]],
+    transfer_mode: str = TRANSFER_BLOCK,
+) -> List[float]:
+    """Write frames to several boards back to back. With TRANSFER_RDWR they all go out
+    in one i2c_rdwr call, one message per board, so no other process can get onto the
+    bus between them.
+
+    Args:
+        frames: (address, frame) pairs in the order to write them
+
+    Returns:
+        list of the time.perf_counter() at which each frame was written
+    """
+    written = []
+    if transfer_mode != TRANSFER_RDWR:
+        for address, frame in frames:
+            write_frame(bus, address, frame)
+            written.append(time.perf_counter())
+        return written
+    messages = [
+        i2c_msg.write(address, bytes((FRAME_REGISTER_RAW,)) + frame)
+        for address, frame in frames
+    ]
+    for i in range(0, len(messages), MAX_RDWR_MESSAGES):
+        bus.i2c_rdwr(*messages[i : i + MAX_RDWR_MESSAGES])
+        written += [time.perf_counter()] * len(messages[i : i + MAX_RDWR_MESSAGES])
+    return written
+
+
+def read_status(bus: SMBus, address: int) -> dict:
+    return decode_status(bus.read_i2c_block_data(address, STATUS_REGISTER, STATUS.size))
+
+
+def read_timing(bus: SMBus, address: int) -> dict:
+    return decode_timing(bus.read_i2c_block_data(address, TIMING_REGISTER, TIMING.size))
+
+
+def read_telemetry(bus: SMBus, address: int) -> dict:
+    return decode_telemetry(
+        bus.read_i2c_block_data(address, TELEMETRY_REGISTER, TELEMETRY.size)
+    )
+
+
+def wait_for_status(bus: SMBus, address: int, sequence: int, timeout: float) -> dict:
+    """Poll the status block until the board reports having handled the frame with the
+    given sequence number.
+
+    Returns:
+        dict: the decoded status, with status "timeout" if the board didn't report the frame
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            status = read_status(bus, address)
+            if status["sequence"] == sequence:
+                return status
+        except OSError:
+            # the board may not answer while it is busy applying the frame
+            pass
+        if time.monotonic() >= deadline:
+            return {"sequence": sequence, "status": "timeout"}
+        time.sleep(ACK_POLL_INTERVAL)
@@ -0,0 +1,228 @@
+from typing import Callable, Dict
+
+from protocol import (
+    ANIMATION_IDS,
+    COLORS,
+    KIND_BYTE,
+    KIND_COLOR,
+    KIND_COLORS,
+    KIND_SHORT,
+    PARAMS,
+)
+
+# values accepted by the render strand param, see MultiLed.render_on_host
+RENDER_VALUES = ("host", "device")
+# largest integer each param kind fits in
+KIND_MAXIMUMS = {KIND_BYTE: 0xFF, KIND_SHORT: 0xFFFF}
+# largest scene id the boards store
+MAX_SCENE_ID = 0xFF
+
+
+def _number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{value!r} is not a number")
+
+
+def _integer(value, maximum: int) -> int:
+    number = int(_number(value))
+    if number < 0 or number > maximum:
+        raise ValueError(f"{value} is out of range 0 to {maximum}")
+    return number
+
+
+def _color(value) -> None:
+    if isinstance(value, str):
+        if value.lower() not in COLORS:
+            raise ValueError(f"unknown color {value}, must be one of {list(COLORS)}")
+        return
+    if not isinstance(value, (list, tuple)) or len(value) != 3:
+        raise ValueError(f"color {value} must be a color name or [r, g, b]")
+    for component in value:
+        _integer(component, 0xFF)
+
+
+def _colors(value) -> None:
+    if not isinstance(value, (list, tuple)) or not value:
+        raise ValueError("colors must be a list of at least one color")
+    for color in value:
+        _color(color)
+
+
+def _animation_name(value) -> None:
+    if value not in ANIMATION_IDS:
+        raise ValueError(
+            f"unknown animation {value}, must be one of {list(ANIMATION_IDS)}"
+        )
+
+
+def _render(value) -> None:
+    if value not in RENDER_VALUES:
+        raise ValueError(f"render must be one of {list(RENDER_VALUES)}")
+
+
+class CommandValidator:
+    """Checks commands against what the firmware accepts before they are sent, so a bad
+    command fails in do_command instead of on the board. The checks for every param are
+    looked up in tables built once per config, a command costs a few dict lookups per
+    param.
+
+    Raises ValueError describing the first problem found.
+    """
+
+    def __init__(self, num_strands: int, strand_length: int) -> None:
+        self.num_strands = num_strands
+        self.strand_length = strand_length
+        self.strand_keys = frozenset(str(i) for i in range(num_strands))
+        self.pixel_keys = frozenset(str(i) for i in range(strand_length))
+        # param name -> check of its value, for the params animations take
+        self.animation_params: Dict[str, Callable] = {"set_animation": _animation_name}
+        for name, kind in PARAMS:
+            if kind == KIND_COLOR:
+                self.animation_params[name] = _color
+            elif kind == KIND_COLORS:
+                self.animation_params[name] = _colors
+            elif kind in KIND_MAXIMUMS:
+                maximum = KIND_MAXIMUMS[kind]
+                self.animation_params[name] = lambda value, m=maximum: _integer(value, m)
+            else:
+                self.animation_params[name] = _number
+        # the animations of a sequence only read colors
+        self.sequence_params = {
+            name: check for name, check in self.animation_params.items() if name != "color"
+        }
+        # and the ones only strand commands take
+        self.strand_params: Dict[str, Callable] = {
+            **self.animation_params,
+            "set_pixel_colors": self._pixel_colors,
+            "sequence": self._sequence,
+            "render": _render,
+        }
+        self.commands: Dict[str, Callable] = {
+            "store_scene": self._store_scene,
+            "play_scene": self._play_scene,
+            "arm": self._scene_command,
+        }
+
+    def validate(self, command) -> None:
+        """Check a command sent to the boards: a strand command or one of the commands
+        in self.commands."""
+        if not isinstance(command, dict) or not command:
+            raise ValueError("command must be a non empty mapping")
+        if all(str(key).isdigit() for key in command):
+            self.validate_strand_command(command)
+            return
+        if len(command) != 1:
+            raise ValueError(
+                f"{list(command)} can't be sent together, send one command at a time"
+            )
+        name, value = next(iter(command.items()))
+        check = self.commands.get(name)
+        if check is None:
+            raise ValueError(f"unknown command {name}")
+        check(value)
+
+    def validate_strand_command(self, command) -> None:
+        """Check a mapping of strand indexes to params, like the ones in commands.json."""
+        if not isinstance(command, dict) or not command:
+            raise ValueError("strand command must map strand indexes to params")
+        for key, params in command.items():
+            if key not in self.strand_keys:
+                self._strand_index(key)
+            if not isinstance(params, dict):
+                raise ValueError(f"params for strand {key} must be a mapping")
+            self._params(key, params)
+
+    def validate_prepared_command(self, command) -> None:
+        """Check a strand command that is encoded ahead of time and sent as is, like the
+        cues of a cue list, so it can't move strands to the host with render."""
+        self.validate_strand_command(command)
+        for key, params in command.items():
+            if "render" in params:
+                raise ValueError(f"strand {key} render is only taken by do_command")
+
+    def _strand_index(self, key) -> None:
+        try:
+            strand = int(key)
+        except (TypeError, ValueError):
+            raise ValueError(f"strand index {key!r} is not an integer")
+        if not 0 <= strand < self.num_strands:
+            raise ValueError(
+                f"strand index {strand} out of range for {self.num_strands} configured strands"
+            )
+
+    def _params(self, key, params: dict) -> None:
+        for name, value in params.items():
+            check = self.strand_params.get(name)
+            if check is None:
+                raise ValueError(f"unknown param {name} for strand {key}")
+            try:
+                check(value)
+            except ValueError as e:
+                raise ValueError(f"strand {key} {name}: {e}")
+
+    def _pixel_colors(self, pixel_colors) -> None:
+        if not isinstance(pixel_colors, dict):
+            raise ValueError("must map pixel indexes to colors")
+        for pixel, color in pixel_colors.items():
+            if pixel not in self.pixel_keys and _integer(pixel, 0xFFFF) >= self.strand_length:
+                raise ValueError(
+                    f"pixel {pixel} out of range for strands of {self.strand_length} pixels"
+                )
+            # whole frames are set this way, so take the common [r, g, b] case fast
+            try:
+                valid = (
+                    isinstance(color, list)
+                    and len(color) == 3
+                    and min(color) >= 0
+                    and max(color) < 0x100
+                )
+            except TypeError:
+                valid = False
+            if not valid:
+                _color(color)
+
+    def _sequence(self, sequence) -> None:
+        if not isinstance(sequence, dict):
+            raise ValueError("must be a mapping with animations and a duration")
+        for name in sequence:
+            if name not in ("animations", "duration"):
+                raise ValueError(f"unknown sequence key {name}")
+        _number(sequence.get("duration", 0))
+        animations = sequence.get("animations", [])
+        if not isinstance(animations, list):
+            raise ValueError("animations must be a list")
+        for i, animation in enumerate(animations):
+            if not isinstance(animation, dict) or "set_animation" not in animation:
+                raise ValueError(f"animation {i} must be a mapping with set_animation")
+            for name, value in animation.items():
+                check = self.sequence_params.get(name)
+                if check is None and name == "color":
+                    raise ValueError(f"animation {i} takes colors, not color")
+                if check is None:
+                    raise ValueError(f"unknown param {name} in animation {i}")
+                check(value)
+
+    def _store_scene(self, store) -> None:
+        if not isinstance(store, dict) or "id" not in store or "command" not in store:
+            raise ValueError("store_scene needs an id and a command")
+        for name in store:
+            if name not in ("id", "command", "persist"):
+                raise ValueError(f"unknown store_scene key {name}")
+        _integer(store["id"], MAX_SCENE_ID)
+        self._scene_command(store["command"], allow_sequences=True)
+
+    def _scene_command(self, command, allow_sequences: bool = False) -> None:
+        """Check the strand command of a stored scene or of arm, which the boards parse
+        ahead of time and can only hold animations in."""
+        self.validate_prepared_command(command)
+        for key, params in command.items():
+            for name in ("set_pixel_colors",) + (
+                () if allow_sequences else ("sequence",)
+            ):
+                if name in params:
+                    raise ValueError(f"strand {key} {name} can't be stored or armed")
+
+    def _play_scene(self, scene_id) -> None:
+        _integer(scene_id, MAX_SCENE_ID)
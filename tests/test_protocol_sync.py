@@ -0,0 +1,134 @@
+"""Checks that the tables the host and the firmware share are in sync, and that what the
+host encodes the firmware decodes back to the same command.
+
+    python -m pytest -q
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# sim puts src on the path for the host modules
+from sim import load_firmware
+
+import protocol
+
+# commands every encoding can express, with speeds and brightness that are exact floats
+COMMANDS = [
+    {"0": {"set_animation": "rainbow_comet", "tail_length": 120, "bounce": 1}},
+    {
+        "1": {
+            "set_animation": "pulse",
+            "speed": 0.25,
+            "period": 10,
+            "colors": ["blue", [1, 2, 3]],
+        },
+        "2": {"set_animation": "solid", "color": "old_lace"},
+    },
+    {"0": {"speed": 0.5, "num_sparkles": 7, "size": 3, "spacing": 4, "step": 20}},
+    {"reconfigure": {"num_strands": 3, "strand_length": 300, "brightness": 0.5}},
+    {
+        "store_scene": {
+            "id": 4,
+            "command": {"0": {"set_animation": "sparkle", "color": "teal"}},
+            "persist": True,
+        }
+    },
+    {"play_scene": 4},
+    {"arm": {"1": {"set_animation": "custom_color_chase", "colors": ["red", "jade"]}}},
+    {"fire": 0},
+    {"set_brightness": 0.75},
+]
+# commands only the JSON encodings express
+JSON_COMMANDS = [
+    {"0": {"sequence": {"animations": [{"set_animation": "comet"}], "duration": 3}}},
+    {"0": {"set_pixel_colors": {"0": [255, 0, 0], "5": "gold"}}},
+]
+
+
+@pytest.fixture(scope="module")
+def firmware():
+    return load_firmware()
+
+
+def binary_form(value, key=None):
+    """The command the firmware's binary decoder gives back: strand indexes as integers
+    and colors as tuples."""
+    if isinstance(value, dict):
+        return {
+            (int(k) if k.isdigit() else k): binary_form(v, k) for k, v in value.items()
+        }
+    if key == "color":
+        return protocol.COLORS[value] if isinstance(value, str) else tuple(value)
+    if key == "colors":
+        return [binary_form(color, "color") for color in value]
+    if key == "store_scene":
+        return {"persist": False, **binary_form(value)}
+    return value
+
+
+def test_tables_match(firmware):
+    assert firmware.TOKENS == protocol.TOKENS
+    assert firmware.TOKEN_BASE == protocol.TOKEN_BASE
+    assert firmware.ANIMATION_NAMES == protocol.ANIMATION_NAMES
+    assert firmware.PARAMS == protocol.PARAMS
+    assert firmware.COLOR_NAMES == tuple(protocol.COLORS)
+
+
+def test_colors_match(firmware):
+    for name, rgb in protocol.COLORS.items():
+        assert tuple(firmware.PixelStrand.get_color(name)) == rgb, name
+
+
+def test_constants_match(firmware):
+    for name in dir(protocol):
+        if name.startswith(("OP_", "ENCODING_", "STATUS_")) or name in (
+            "FRAME_MAGIC",
+            "FRAME_REGISTER",
+            "FRAME_REGISTER_RAW",
+            "TIMING_REGISTER",
+            "TELEMETRY_REGISTER",
+            "MESSAGE_CHUNK_SIZE",
+            "PROTOCOL_VERSION",
+            "RUN_FILL",
+            "SCENE_PERSIST",
+        ):
+            if isinstance(getattr(protocol, name), int):
+                assert getattr(firmware, name) == getattr(protocol, name), name
+
+
+@pytest.mark.parametrize("command", COMMANDS + JSON_COMMANDS)
+@pytest.mark.parametrize("encoding", [protocol.ENCODING_JSON, protocol.ENCODING_TOKENS])
+def test_json_round_trip(firmware, encoding, command):
+    used, payload = protocol.encode_message(command, encoding)
+    assert used == encoding
+    assert firmware.decode_message(used, payload) == command
+
+
+@pytest.mark.parametrize("command", COMMANDS)
+def test_binary_round_trip(firmware, command):
+    used, payload = protocol.encode_message(command, protocol.ENCODING_BINARY)
+    assert used == protocol.ENCODING_BINARY
+    assert firmware.decode_message(used, payload) == binary_form(command)
+
+
+def test_binary_pixel_runs(firmware):
+    pixel_colors = {str(i): [i, 0, 255 - i] for i in range(10)}
+    pixel_colors.update({str(i): "red" for i in range(10, 20)})
+    used, payload = protocol.encode_message(
+        {"0": {"set_pixel_colors": pixel_colors}}, protocol.ENCODING_BINARY
+    )
+    assert used == protocol.ENCODING_BINARY
+    runs = firmware.decode_message(used, payload)[0]["set_pixel_colors"]
+    pixels = {}
+    for start, length, data in runs:
+        for i in range(length):
+            offset = 0 if len(data) == 3 else i * 3
+            pixels[start + i] = tuple(data[offset : offset + 3])
+    assert pixels == {
+        int(i): protocol.COLORS[c] if isinstance(c, str) else tuple(c)
+        for i, c in pixel_colors.items()
+    }